@@ -0,0 +1,268 @@
+# 文件名：api_server.py
+#
+# 无界面的 OpenAI 兼容接口：POST /v1/chat/completions（支持 SSE 流式输出）。
+# 和 app_v8.py 行为一致：同样的系统提示词、“最近N条”上下文窗口、token 统计和负载均衡客户端，
+# 内部工具不用再驱动浏览器或复制一份逻辑。上游调用用 llm_client.astream_chat，
+# 同一套传输层，但不为每个分块构造 LangChain 对象，一个进程可以同时维持大量流。
+#
+# 用法：
+#   python api_server.py --port 8000 --secrets .streamlit/secrets.toml
+#
+# 停止输出：客户端断开连接即可；也可以
+#   POST /v1/chat/completions/{id}/cancel   （id 在响应头 X-Completion-Id 和每个分块的 id 字段里）
+# 检测到重复循环 / 低熵停滞时提前结束（见 degenerate.py），finish_reason 为 "degenerate"。
+
+import argparse
+import asyncio
+import json
+import time
+import uuid
+
+import toml
+from aiohttp import web
+
+from chat_core import BadRequest, CONTEXT_WINDOW, count_tokens, get_model_context, parse_messages
+from degenerate import DegenerationMonitor, estimate_savings
+from input_compress import CompressConfig, compress_context
+from llm_balancer import pool_from_secrets
+from llm_client import (DEFAULT_API_BASE, DEFAULT_MODEL, REPLAY_SECRETS, astream_chat, cassette_mode,
+                        close_http_clients, make_http_clients)
+
+########################################
+# 1) 响应格式
+########################################
+def error_response(status, message):
+    return web.json_response({"error": {"message": message}}, status=status)
+
+def chunk_payload(completion_id, created, delta, finish_reason=None, usage=None):
+    data = {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": created,
+        "model": DEFAULT_MODEL,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+    if usage is not None:
+        data["usage"] = usage
+    return f"data: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8")
+
+def usage_payload(prompt_tokens, completion_text, saved_tokens=0, truncation=None):
+    completion_tokens = count_tokens(completion_text)
+    usage = {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+        "prompt_tokens_saved": saved_tokens,  # 发送前压缩节省的 token 数
+    }
+    if truncation is not None:
+        # 因退化输出提前结束：原因，以及节省的输出 token 数和秒数的上限（按剩余的 max_tokens 额度算）
+        reason, saved, seconds = truncation
+        usage["degenerate"] = {"reason": reason, "completion_tokens_saved_max": saved,
+                               "seconds_saved_max": round(seconds, 2)}
+    return usage
+
+def check_degenerate(monitor, text, n_chunks, max_tokens, started, first_token_at):
+    """把新分块交给监视器；发现退化时返回 (原因, 节省 tokens, 节省秒数)，否则返回 None。"""
+    if monitor is None:
+        return None
+    reason = monitor.feed(text)
+    if reason is None:
+        return None
+    saved, seconds = estimate_savings(n_chunks, max_tokens, time.monotonic() - started,
+                                      first_token_at - started)
+    return reason, saved, seconds
+
+########################################
+# 2) 对话服务
+########################################
+class ChatService:
+    def __init__(self, pool, context_window=CONTEXT_WINDOW, compress_config=None,
+                 detect_degenerate=True):
+        self.pool = pool
+        self.context_window = context_window
+        self.compress_config = compress_config  # None 表示不压缩
+        self.detect_degenerate = detect_degenerate
+        # 所有请求共用一组 httpx 连接，避免每个请求都重新建连
+        self.http_clients = make_http_clients(pool)
+        self.stop_events = {}  # 进行中的请求 id -> asyncio.Event
+
+    async def chat_completions(self, request):
+        try:
+            payload = await request.json()
+            messages = parse_messages(payload)
+            window = int(payload.get("context_window", self.context_window))
+            temperature = float(payload.get("temperature", 0.7))
+            max_tokens = int(payload.get("max_tokens", 1024))
+            if window < 1:
+                # n=0 时 get_model_context 的 conv_msgs[-0:] 会返回整段对话，负数则随意截取
+                raise BadRequest("context_window 必须是正整数")
+        except (ValueError, TypeError, BadRequest) as e:
+            return error_response(400, str(e))
+
+        context = get_model_context(messages, n=window)
+        saved_tokens = 0
+        if self.compress_config is not None:
+            context, saved_tokens = compress_context(context, self.compress_config)
+        prompt_tokens = sum(count_tokens(m.content) for m in context)
+        usage_info = (prompt_tokens, saved_tokens)
+        llm_kwargs = dict(
+            pool=self.pool,
+            http_clients=self.http_clients,
+            temperature=temperature,
+            max_tokens=max_tokens,
+        )
+
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        stop_event = asyncio.Event()
+        self.stop_events[completion_id] = stop_event
+        try:
+            if payload.get("stream"):
+                return await self._stream(request, context, llm_kwargs, usage_info,
+                                          completion_id, stop_event)
+            return await self._complete(context, llm_kwargs, usage_info, completion_id, stop_event)
+        finally:
+            self.stop_events.pop(completion_id, None)
+
+    async def _stream(self, request, context, llm_kwargs, usage_info, completion_id, stop_event):
+        created = int(time.time())
+        response = web.StreamResponse(headers={
+            "Content-Type": "text/event-stream",
+            "Cache-Control": "no-cache",
+            "X-Completion-Id": completion_id,
+        })
+        await response.prepare(request)
+        await response.write(chunk_payload(completion_id, created, {"role": "assistant", "content": ""}))
+
+        parts = []
+        finish_reason = "stop"
+        truncation = None
+        monitor = DegenerationMonitor() if self.detect_degenerate else None
+        started = time.monotonic()
+        first_token_at = None
+        upstream = astream_chat(context, **llm_kwargs)
+        try:
+            async for text in upstream:
+                if stop_event.is_set():
+                    finish_reason = "cancelled"
+                    break
+                first_token_at = first_token_at or time.monotonic()
+                parts.append(text)
+                await response.write(chunk_payload(completion_id, created, {"content": text}))
+                truncation = check_degenerate(monitor, text, len(parts), llm_kwargs["max_tokens"],
+                                              started, first_token_at)
+                if truncation is not None:
+                    finish_reason = "degenerate"
+                    break
+        except ConnectionResetError:
+            # 客户端已断开：关闭上游连接即可，不再写回
+            return response
+        except Exception as e:
+            await response.write(f"data: {json.dumps({'error': {'message': str(e)}}, ensure_ascii=False)}\n\n".encode("utf-8"))
+            return response
+        finally:
+            # 提前结束时关闭上游流，不再为后面的 token 付费
+            await upstream.aclose()
+
+        usage = usage_payload(usage_info[0], "".join(parts), usage_info[1], truncation)
+        try:
+            await response.write(chunk_payload(completion_id, created, {}, finish_reason, usage))
+            await response.write(b"data: [DONE]\n\n")
+            await response.write_eof()
+        except ConnectionResetError:
+            pass
+        return response
+
+    async def _complete(self, context, llm_kwargs, usage_info, completion_id, stop_event):
+        parts = []
+        finish_reason = "stop"
+        truncation = None
+        monitor = DegenerationMonitor() if self.detect_degenerate else None
+        started = time.monotonic()
+        first_token_at = None
+        upstream = astream_chat(context, **llm_kwargs)
+        try:
+            async for text in upstream:
+                if stop_event.is_set():
+                    finish_reason = "cancelled"
+                    break
+                first_token_at = first_token_at or time.monotonic()
+                parts.append(text)
+                truncation = check_degenerate(monitor, text, len(parts), llm_kwargs["max_tokens"],
+                                              started, first_token_at)
+                if truncation is not None:
+                    finish_reason = "degenerate"
+                    break
+        except Exception as e:
+            return error_response(502, str(e))
+        finally:
+            await upstream.aclose()
+        content = "".join(parts)
+        return web.json_response({
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": DEFAULT_MODEL,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": finish_reason,
+            }],
+            "usage": usage_payload(usage_info[0], content, usage_info[1], truncation),
+        }, dumps=lambda obj: json.dumps(obj, ensure_ascii=False))
+
+    async def cancel(self, request):
+        stop_event = self.stop_events.get(request.match_info["completion_id"])
+        if stop_event is None:
+            return error_response(404, "没有找到进行中的请求")
+        stop_event.set()
+        return web.json_response({"id": request.match_info["completion_id"], "cancelled": True})
+
+    async def models(self, request):
+        return web.json_response({
+            "object": "list",
+            "data": [{"id": DEFAULT_MODEL, "object": "model", "owned_by": "deepseek"}],
+        })
+
+    async def close(self, app):
+        await close_http_clients(self.http_clients)
+
+def create_app(pool, context_window=CONTEXT_WINDOW, compress_config=None, detect_degenerate=True):
+    service = ChatService(pool, context_window, compress_config, detect_degenerate)
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", service.chat_completions)
+    app.router.add_post("/v1/chat/completions/{completion_id}/cancel", service.cancel)
+    app.router.add_get("/v1/models", service.models)
+    app.on_cleanup.append(service.close)
+    return app
+
+########################################
+# 3) 命令行入口
+########################################
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI 兼容的流式对话接口（与 app_v8 行为一致）")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--secrets", default=".streamlit/secrets.toml",
+                        help="与 Streamlit 应用共用的 secrets.toml（读取其中的 [openai] 配置）")
+    parser.add_argument("--context-window", type=int, default=CONTEXT_WINDOW,
+                        help="传给模型的最近对话条数")
+    parser.add_argument("--no-compress", action="store_true",
+                        help="关闭发送前的输入压缩（见 input_compress.py）")
+    parser.add_argument("--no-degenerate-check", action="store_true",
+                        help="关闭重复循环 / 低熵输出检测（见 degenerate.py）")
+    args = parser.parse_args()
+    if args.context_window < 1:
+        parser.error("--context-window 必须是正整数")
+
+    if cassette_mode() == "replay":
+        openai_secrets = REPLAY_SECRETS  # 回放不联网，不需要 secrets.toml
+    else:
+        openai_secrets = toml.load(args.secrets)["openai"]
+    pool = pool_from_secrets(openai_secrets, DEFAULT_API_BASE)
+    compress_config = None if args.no_compress else CompressConfig()
+    web.run_app(create_app(pool, args.context_window, compress_config,
+                           not args.no_degenerate_check),
+                host=args.host, port=args.port)
+
+if __name__ == "__main__":
+    main()
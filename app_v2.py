@@ -6,6 +6,8 @@ from langchain_openai import ChatOpenAI
 from langchain.schema import AIMessage, HumanMessage, SystemMessage
 import tiktoken
 
+from input_compress import compress_context, saved_note
+
 # --- 辅助函数：计算 token 数量 ---
 def count_tokens(text, model_name="deepseek-chat"):
     """
@@ -53,7 +55,8 @@ if prompt:
     user_message.write(prompt)
 
     # 调用模型，将完整对话历史传入，实现多轮上下文对话
-    ai_response = llm(st.session_state.messages)
+    context_for_llm, saved = compress_context(st.session_state.messages)
+    ai_response = llm(context_for_llm)
     ai_content = ai_response.content
 
     # 将 AI 回复加入历史
@@ -66,7 +69,7 @@ if prompt:
     ai_message.write(ai_content)
 
     # 显示本轮对话消耗的 token 数量
-    st.write(f"本轮消耗 token 数：用户输入 {user_token_count} tokens，AI回复 {ai_token_count} tokens，总计 {user_token_count + ai_token_count} tokens。")
+    st.write(f"本轮消耗 token 数：用户输入 {user_token_count} tokens，AI回复 {ai_token_count} tokens，总计 {user_token_count + ai_token_count} tokens{saved_note(saved)}。")
     
     # 将本轮 token 记录保存到 session_state
     st.session_state.token_usage.append((user_token_count, ai_token_count))
@@ -5,6 +5,8 @@ from langchain_openai import ChatOpenAI
 from langchain.schema import AIMessage, HumanMessage, SystemMessage
 import tiktoken
 
+from input_compress import compress_context, saved_note
+
 # --- 辅助函数：计算 token 数量 ---
 def count_tokens(text, model_name="deepseek-chat"):
     try:
@@ -50,13 +52,14 @@ if prompt:
     
     # 显示加载动画，避免界面长时间“灰屏”
     with st.spinner("AI 正在回复，请稍等..."):
-        ai_response = llm(st.session_state.messages)
+        context_for_llm, saved = compress_context(st.session_state.messages)
+        ai_response = llm(context_for_llm)
     ai_content = ai_response.content
     st.session_state.messages.append(AIMessage(content=ai_content))
     ai_token_count = count_tokens(ai_content)
     
     # 显示本轮对话的 token 消耗
-    st.write(f"本轮消耗 token 数：用户输入 {user_token_count} tokens，AI回复 {ai_token_count} tokens，总计 {user_token_count + ai_token_count} tokens。")
+    st.write(f"本轮消耗 token 数：用户输入 {user_token_count} tokens，AI回复 {ai_token_count} tokens，总计 {user_token_count + ai_token_count} tokens{saved_note(saved)}。")
 
 # --- 始终显示完整的对话记录（不包括 SystemMessage） ---
 with conversation_container:
@@ -3,6 +3,8 @@ from langchain_openai import ChatOpenAI
 from langchain.schema import AIMessage, HumanMessage, SystemMessage
 import tiktoken
 
+from input_compress import compress_context, saved_note
+
 # 辅助函数：计算 token 数量，并返回整数
 def count_tokens(text, model_name="deepseek-chat"):
     try:
@@ -27,6 +29,8 @@ if "messages" not in st.session_state:
     st.session_state.messages = [SystemMessage(content="你是一个乐于助人的AI助手。")]
 if "tokens" not in st.session_state:
     st.session_state.tokens = [0]  # 为系统消息添加占位 token
+if "saved_tokens" not in st.session_state:
+    st.session_state.saved_tokens = {}  # 用户消息下标 -> 这一轮发送前压缩节省的 token 数
 
 
 st.title("我的DeepSeek")
@@ -47,7 +51,7 @@ for i, msg in enumerate(st.session_state.messages):
         # 在用户消息下方显示灰色 token 信息
         # 这里 st.session_state.tokens[i] 是这个 HumanMessage 的 token 数
         user_chat.write(
-            f"<p style='color:gray;font-size:0.8rem;'>[用户消耗 {st.session_state.tokens[i]} tokens]</p>",
+            f"<p style='color:gray;font-size:0.8rem;'>[用户消耗 {st.session_state.tokens[i]} tokens{saved_note(st.session_state.saved_tokens.get(i, 0))}]</p>",
             unsafe_allow_html=True
         )
     elif isinstance(msg, AIMessage):
@@ -74,10 +78,14 @@ if prompt:
     # 计算用户输入的 token 数量并存储
     user_tokens = count_tokens(prompt)
     st.session_state.tokens.append(user_tokens)
+
+    # 传给模型的是压缩后的副本，节省的 token 数记在这条用户消息上
+    context_for_llm, saved = compress_context(st.session_state.messages)
+    st.session_state.saved_tokens[len(st.session_state.messages) - 1] = saved
     
     # 在用户消息下方显示灰色 token 信息
     user_chat.write(
-        f"<p style='color:gray;font-size:0.8rem;'>[用户消耗 {user_tokens} tokens]</p>",
+        f"<p style='color:gray;font-size:0.8rem;'>[用户消耗 {user_tokens} tokens{saved_note(saved)}]</p>",
         unsafe_allow_html=True
     )
     
@@ -85,7 +93,7 @@ if prompt:
     with st.chat_message("assistant"):
         with st.spinner("AI 正在回复，请稍等..."):
             # 调用 LLM，传入所有消息（包括系统消息 + 历史用户/AI消息 + 当前这条用户消息）
-            ai_response = llm(st.session_state.messages)
+            ai_response = llm(context_for_llm)
             ai_content = ai_response.content
             
             # 把 AI 回复保存到 session_state
@@ -4,6 +4,8 @@ from langchain.schema import AIMessage, HumanMessage, SystemMessage
 from langchain.callbacks.base import BaseCallbackHandler
 import tiktoken
 
+from input_compress import compress_context, saved_note
+
 # -----------------------------
 # 1) 自定义回调 Handler，用于流式逐字渲染
 # -----------------------------
@@ -65,6 +67,7 @@ llm = ChatOpenAI(
 if "messages" not in st.session_state:
     st.session_state.messages = []
     st.session_state.tokens = []
+    st.session_state.saved_tokens = {}  # 用户消息下标 -> 发送前压缩节省的 token 数
     # 先放一个 system 消息
     sys_msg = SystemMessage(content="你是一个乐于助人的AI助手。")
     st.session_state.messages.append(sys_msg)
@@ -85,7 +88,7 @@ for i, (msg, tcount) in enumerate(zip(st.session_state.messages, st.session_stat
         user_bubble = st.chat_message("user")
         user_bubble.write(msg.content)
         user_bubble.write(
-            f"<p style='color:gray;font-size:0.8rem;'>[用户消耗 {tcount} tokens]</p>",
+            f"<p style='color:gray;font-size:0.8rem;'>[用户消耗 {tcount} tokens{saved_note(st.session_state.saved_tokens.get(i, 0))}]</p>",
             unsafe_allow_html=True
         )
     elif isinstance(msg, AIMessage):
@@ -111,12 +114,14 @@ if prompt:
     
     user_token_count = count_tokens(prompt)
     st.session_state.tokens.append(user_token_count)
+    context_for_llm, saved = compress_context(st.session_state.messages)
+    st.session_state.saved_tokens[len(st.session_state.messages) - 1] = saved
 
     # 显示用户聊天气泡
     user_bubble = st.chat_message("user")
     user_bubble.write(prompt)
     user_bubble.write(
-        f"<p style='color:gray;font-size:0.8rem;'>[用户消耗 {user_token_count} tokens]</p>",
+        f"<p style='color:gray;font-size:0.8rem;'>[用户消耗 {user_token_count} tokens{saved_note(saved)}]</p>",
         unsafe_allow_html=True
     )
 
@@ -131,7 +136,7 @@ if prompt:
     # 调用 LLM，传入全部消息 + 回调
     # 如果 deepseek-chat 不支持流式，这里会一次性返回
     ai_response = llm(
-        st.session_state.messages,
+        context_for_llm,
         callbacks=[stream_handler],  # 传入我们的流式回调
     )
 
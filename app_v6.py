@@ -5,6 +5,8 @@ from langchain_openai import ChatOpenAI
 from langchain.schema import AIMessage, HumanMessage, SystemMessage
 import tiktoken
 
+from input_compress import compress_context, saved_note
+
 class StreamlitStreamingCallbackHandler(BaseCallbackHandler):
     """
     每当大模型生成新的 token，就拼到 self.partial_text，实时更新到 Streamlit 前端。
@@ -40,6 +42,8 @@ if "messages" not in st.session_state:
 
 if "tokens" not in st.session_state:
     st.session_state.tokens = [0]  # 为系统消息占位
+if "saved_tokens" not in st.session_state:
+    st.session_state.saved_tokens = {}  # 用户消息下标 -> 这一轮发送前压缩节省的 token 数
 
 st.title("我的DeepSeek")
 
@@ -52,7 +56,7 @@ for i, msg in enumerate(st.session_state.messages):
         user_chat.write(msg.content)
         # 显示 token 消息
         user_chat.write(
-            f"<p style='color:gray;font-size:0.8rem;'>[用户消耗 {st.session_state.tokens[i]} tokens]</p>",
+            f"<p style='color:gray;font-size:0.8rem;'>[用户消耗 {st.session_state.tokens[i]} tokens{saved_note(st.session_state.saved_tokens.get(i, 0))}]</p>",
             unsafe_allow_html=True
         )
     elif isinstance(msg, AIMessage):
@@ -78,8 +82,11 @@ if prompt:
     # 统计用户输入 tokens
     user_tokens = count_tokens(prompt)
     st.session_state.tokens.append(user_tokens)
+
+    context_for_llm, saved = compress_context(st.session_state.messages)
+    st.session_state.saved_tokens[len(st.session_state.messages) - 1] = saved
     user_chat.write(
-        f"<p style='color:gray;font-size:0.8rem;'>[用户消耗 {user_tokens} tokens]</p>",
+        f"<p style='color:gray;font-size:0.8rem;'>[用户消耗 {user_tokens} tokens{saved_note(saved)}]</p>",
         unsafe_allow_html=True
     )
 
@@ -107,7 +114,7 @@ if prompt:
     # 在 Streamlit 上给个提示转圈
     with st.spinner("AI 正在回复，请稍等..."):
         # 传入所有历史消息，让 AI 生成
-        ai_response = llm(st.session_state.messages)
+        ai_response = llm(context_for_llm)
         ai_content = ai_response.content  # 生成结束后拿到完整文本
 
     # c) 记录 AI 消息到 session_state
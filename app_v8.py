@@ -1,12 +1,25 @@
+import threading
+import time
+import uuid
+
 import streamlit as st
-from langchain_openai import ChatOpenAI  # deepseek-chat兼容
+from streamlit.errors import StreamlitAPIException
 from langchain.callbacks.manager import CallbackManager
 from langchain.callbacks.base import BaseCallbackHandler
 from langchain.schema import SystemMessage, HumanMessage, AIMessage
-import tiktoken
+from chat_core import CONTEXT_WINDOW, SYSTEM_PROMPT, count_tokens, get_model_context
+from llm_client import DEFAULT_API_BASE, REPLAY_SECRETS, cassette_mode, create_chat_llm  # deepseek-chat兼容
+from llm_balancer import pool_from_secrets
+from delta_stream import DeltaCursor, delta_stream
+from input_compress import CompressConfig, compress_context, saved_note
+from degenerate import DegenerateOutputException, DegenerationMonitor, estimate_savings
+from turn_metrics import TurnMetricsRecorder
+import doc_qa
 
 ########################################
 # 0) 页面设置 & CSS 美化
+#    （只在整页运行时执行；输入、流式输出、停止按钮都在 fragment 里，
+#     交互时不会重新执行这里）
 ########################################
 st.set_page_config(page_title="我的DeepSeek", layout="centered")
 
@@ -30,11 +43,16 @@ st.markdown(page_bg, unsafe_allow_html=True)
 # 1) 置顶的“重置对话”按钮
 ########################################
 if st.button("重置对话"):
-    # 只需直接清空相关的 session_state 数据
-    st.session_state.messages = [SystemMessage(content="你是一个乐于助人的AI助手。")]
+    # 若后台仍在生成，先通知它停止，再清空相关的 session_state 数据
+    for job in st.session_state.get("stream_jobs", []):
+        job.stop_event.set()
+    st.session_state.messages = [SystemMessage(content=SYSTEM_PROMPT)]
     st.session_state.tokens = [0]
-    st.session_state.stop_requested = False
-    st.session_state.partial_text = ""  # 清空临时输出
+    st.session_state.saved_tokens = {}
+    st.session_state.truncations = {}
+    st.session_state.turn_errors = {}
+    st.session_state.stream_jobs = []
+    st.session_state.turn_queue = []
     # 不做任何强制刷新或 st.stop，继续执行脚本即可
 
 st.title("我的DeepSeek")
@@ -45,6 +63,29 @@ st.markdown("欢迎和我聊天")
 ########################################
 SHOW_TOKENS = True  # 改成 False 即可隐藏 token 信息
 
+# 流式输出时只向浏览器发送新增的文本片段（见 delta_stream.py）；改成 False 则每次重发整段
+USE_DELTA_STREAM = True
+
+# 流式输出期间，fragment 每隔多少秒刷新一次界面
+POLL_INTERVAL = 0.1
+
+# 对比模式最多同时生成几个候选回答
+MAX_CANDIDATES = 4
+
+# 发送前压缩上下文副本（空白规整 / 重复行与重复段落折叠 / 超长段落截断，见 input_compress.py）；
+# 界面上显示的消息不受影响。改成 False 即原样发送
+COMPRESS_INPUT = True
+COMPRESS_CONFIG = CompressConfig()
+
+# 单次回复的 token 上限
+MAX_TOKENS = 1024
+
+# 流式输出时检测重复循环 / 低熵停滞，发现后提前停止生成（见 degenerate.py）。改成 False 即关闭
+DETECT_DEGENERATE = True
+
+# 记录每轮的延迟 / token 等指标，批量写入 Parquet（见 turn_metrics.py）。改成 False 即不记录
+RECORD_METRICS = True
+
 ########################################
 # 3) 自定义异常 & 回调处理器
 ########################################
@@ -52,158 +93,560 @@ class StopStreamingException(Exception):
     """用户请求中止流式输出时抛出的异常。"""
     pass
 
-class StreamlitStreamingCallbackHandler(BaseCallbackHandler):
-    """自定义回调，用于在流式输出时检查停止标志、累计输出到 partial_text。"""
-    def __init__(self, placeholder):
-        self.placeholder = placeholder
+class StreamJob:
+    """一次在后台线程里运行的流式生成；界面只负责轮询读取它的进度。"""
+    def __init__(self, context, temperature=0.7, max_tokens=MAX_TOKENS):
+        self.context = context
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.partial_text = ""      # 已生成的内容，停止后也会保留
+        self.n_tokens = 0           # 已收到的 token 数
+        self.stop_event = threading.Event()
+        self.done = False
+        self.error = None
+        self.cancelled = False      # 用户中止
+        self.prompt_tokens = 0      # 实际传给模型的上下文 token 数（压缩后）
+        self.started_at = time.time()
+        self.first_token_at = None  # 首个 token 到达时间，用于统计首字延迟
+        self.finished_at = None
+        self.cursor = DeltaCursor() # 已经发到浏览器的位置
+        self.status = "AI 正在思考..."  # 还没有输出内容时显示的提示
+        self.monitor = DegenerationMonitor() if DETECT_DEGENERATE else None
+        self.truncation = None      # 因退化输出提前截断时为 (原因, 节省 tokens, 节省秒数)
+
+    def prepare(self):
+        """调用模型前的准备工作（子类覆盖）；执行完后 self.context 即为要发送的上下文。"""
+        pass
+
+    def run(self, llm):
+        try:
+            self.prepare()
+            if self.stop_event.is_set():
+                raise StopStreamingException("用户请求中止流式输出。")
+            ai_response = llm(self.context)
+            self.partial_text = ai_response.content
+        except StopStreamingException:
+            # 若中断，则只保留现有 partial_text
+            self.cancelled = True
+        except DegenerateOutputException as e:
+            # 退化输出：同样保留已生成的部分，并记下节省了多少
+            first_token_delay = (self.first_token_at or self.started_at) - self.started_at
+            saved_tokens, saved_seconds = estimate_savings(
+                self.n_tokens, self.max_tokens, time.time() - self.started_at, first_token_delay
+            )
+            self.truncation = (e.reason, saved_tokens, saved_seconds)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.finished_at = time.time()
+            self.done = True
+
+    def stats_text(self):
+        """返回“输出 token 数 / 首字延迟 / 总用时”的简短说明。"""
+        end = self.finished_at or time.time()
+        text = f"输出 {self.n_tokens} tokens · 用时 {end - self.started_at:.1f}s"
+        if self.first_token_at is not None:
+            text += f" · 首字 {self.first_token_at - self.started_at:.1f}s"
+        if self.truncation is not None:
+            text += f" · 重复输出已截断，最多节省 {self.truncation[1]} tokens"
+        return text
+
+class DocQAJob(StreamJob):
+    """针对上传文档的提问：先并发阅读相关片段（map），再流式输出汇总回答（reduce），见 doc_qa.py。"""
+    def __init__(self, question, attachment, pool, temperature=0.3):
+        super().__init__(None, temperature)
+        self.question = question
+        self.attachment = attachment
+        self.pool = pool
+
+    def prepare(self):
+        path, file_hash = self.attachment["path"], self.attachment["hash"]
+        chunks = doc_qa.load_chunks(path, file_hash)
+        self.status = f"正在从 {len(chunks)} 个片段中挑选相关内容..."
+        selected = doc_qa.select_chunks(path, chunks, self.question)
+        self.status = f"正在阅读 {len(selected)} 个相关片段..."
+        notes, failed = doc_qa.map_chunks(
+            selected, self.question, self.pool,
+            stop_event=self.stop_event, on_progress=self._on_progress,
+        )
+        failed_info = f"，{len(failed)} 个读取失败" if failed else ""
+        self.status = f"已读完 {len(selected)} 个片段（{len(notes)} 个相关{failed_info}），正在汇总回答..."
+        self.context = doc_qa.reduce_messages(notes, self.question, self.attachment["name"], failed)
+        self.prompt_tokens = sum(count_tokens(m.content) for m in self.context)
+
+    def _on_progress(self, done, total):
+        self.status = f"正在阅读相关片段（{done}/{total}）..."
+
+class QueuedTurn:
+    """排队等待发送的一轮：入队时就完成分词和上下文准备，发送时只需填入前面几轮的回答。"""
+    def __init__(self, prompt, tokens, context, saved, expected_len):
+        self.turn_id = uuid.uuid4().hex
+        self.prompt = prompt
+        self.tokens = tokens              # 问题的 token 数
+        self.context = context            # 传给模型的上下文；尚未生成的回答先用它在 messages 里的下标占位
+        self.saved = saved                # 发送前压缩节省的 token 数；None 表示发送时再压缩
+        self.expected_len = expected_len  # 发送时 messages 应有的长度，不一致说明前面的轮次有变化，需重新准备
+
+class StreamJobCallbackHandler(BaseCallbackHandler):
+    """自定义回调，用于在流式输出时检查停止标志、累计输出到 job.partial_text。"""
+    # 默认情况下回调里的异常会被 LangChain 吞掉，这里需要让它真正中断生成
+    raise_error = True
+
+    def __init__(self, job):
+        self.job = job
 
     def on_llm_new_token(self, token: str, **kwargs) -> None:
-        # 每生成一个token前都检测：若 stop_requested==True，则抛异常中断
-        if st.session_state.get("stop_requested", False):
+        # 每生成一个token前都检测：若已请求停止，则抛异常中断
+        if self.job.stop_event.is_set():
             raise StopStreamingException("用户请求中止流式输出。")
-        # 追加新token到 partial_text
-        st.session_state.partial_text += token
-        # 在界面写出累计内容
-        self.placeholder.write(st.session_state.partial_text)
-
-########################################
-# 4) token 统计函数
-########################################
-def count_tokens(text, model_name="deepseek-chat"):
-    try:
-        encoding = tiktoken.encoding_for_model(model_name)
-    except:
-        encoding = tiktoken.get_encoding("cl100k_base")
-    return len(encoding.encode(text))
+        # 角色分块等没有内容的分块不算 token，也不交给退化检测（连续的空 token 会被当成周期为 1 的循环）
+        if not token:
+            return
+        if self.job.first_token_at is None:
+            self.job.first_token_at = time.time()
+        # 追加新token到 partial_text（后台线程里不能访问 st.*，界面由 fragment 负责刷新）
+        self.job.partial_text += token
+        self.job.n_tokens += 1
+        # 检测到重复循环 / 低熵停滞时抛异常，上游连接随之关闭，不再为剩下的 token 付费
+        if self.job.monitor is not None:
+            reason = self.job.monitor.feed(token)
+            if reason is not None:
+                raise DegenerateOutputException(reason)
 
 ########################################
-# 5) 初始化 session_state
+# 4) 初始化 session_state
 ########################################
 if "messages" not in st.session_state:
-    st.session_state.messages = [SystemMessage(content="你是一个乐于助人的AI助手。")]
+    st.session_state.messages = [SystemMessage(content=SYSTEM_PROMPT)]
 
 if "tokens" not in st.session_state:
     st.session_state.tokens = [0]  # 对应上面SystemMessage
 
-if "stop_requested" not in st.session_state:
-    st.session_state.stop_requested = False
+# 当前这一轮的流式生成：普通模式 1 个，对比模式 K 个；空列表表示空闲
+if "stream_jobs" not in st.session_state:
+    st.session_state.stream_jobs = []
+
+# 没有得到回答的轮次：用户消息下标 -> 错误信息
+if "turn_errors" not in st.session_state:
+    st.session_state.turn_errors = {}
+
+# 生成过程中提交、等待发送的问题（QueuedTurn），当前回答结束后按顺序发送
+if "turn_queue" not in st.session_state:
+    st.session_state.turn_queue = []
+
+# 每轮发送前压缩节省的 token 数：用户消息下标 -> 节省数
+if "saved_tokens" not in st.session_state:
+    st.session_state.saved_tokens = {}
+
+# 因退化输出被提前截断的回复：AI 消息下标 -> (原因, 节省 tokens, 节省秒数)
+if "truncations" not in st.session_state:
+    st.session_state.truncations = {}
+
+# 当前上传的文档：只保存 {name, path, hash, file_id}，文件内容在磁盘上按需 mmap 读取
+if "attachment" not in st.session_state:
+    st.session_state.attachment = None
 
-# 用于存放“流式生成中的临时文本”，防止停止后已输出的部分被清空
-if "partial_text" not in st.session_state:
-    st.session_state.partial_text = ""
+# 指标记录里区分不同会话
+if "session_id" not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
+
+# 本轮传给模型的上下文 token 数（对比模式下所有候选共用，只统计一次）
+if "context_tokens" not in st.session_state:
+    st.session_state.context_tokens = 0
 
 ########################################
-# 6) 回放对话历史
+# 5) 回放对话历史
 ########################################
-for i, msg in enumerate(st.session_state.messages):
-    if isinstance(msg, SystemMessage):
-        continue  # 不展示系统消息
-    elif isinstance(msg, HumanMessage):
+def render_message(msg, tokens, saved=0, truncation=None, error=None):
+    """在界面上画出一条 Human/AIMessage（系统消息不展示）。"""
+    if isinstance(msg, HumanMessage):
         with st.chat_message("user"):
             st.write(msg.content)
             if SHOW_TOKENS:
                 st.write(
-                    f"<p class='token-info'>[用户消耗 {st.session_state.tokens[i]} tokens]</p>",
+                    f"<p class='token-info'>[用户消耗 {tokens} tokens{saved_note(saved)}]</p>",
                     unsafe_allow_html=True
                 )
+        if error is not None:
+            st.error(f"这一轮没有得到回答：{error}")
     elif isinstance(msg, AIMessage):
         with st.chat_message("assistant"):
             st.write(msg.content)
+            if truncation is not None:
+                reason, saved_tokens, saved_seconds = truncation
+                st.caption(f"{reason}，已提前截断（最多节省 {saved_tokens} tokens / {saved_seconds:.1f} 秒）")
             if SHOW_TOKENS:
                 st.write(
-                    f"<p class='token-info'>[AI消耗 {st.session_state.tokens[i]} tokens]</p>",
+                    f"<p class='token-info'>[AI消耗 {tokens} tokens]</p>",
                     unsafe_allow_html=True
                 )
 
+# 整页运行时画出的历史条数；之后新增的消息由下面的 fragment 负责画。
+# 每轮结束后整页刷新一次，所以 fragment 里只有当前这一轮的消息
+history_len = len(st.session_state.messages)
+for i in range(history_len):
+    render_message(st.session_state.messages[i], st.session_state.tokens[i],
+                   st.session_state.saved_tokens.get(i, 0),
+                   st.session_state.truncations.get(i),
+                   st.session_state.turn_errors.get(i))
+
 ########################################
-# 7) 函数：获取“系统消息 + 最近N条”
+# 6) 开始 / 结束一轮对话
 ########################################
-def get_model_context(messages, n=10):
-    """返回：SystemMessage + 最后 n 条 (Human/AIMessage)。"""
-    if len(messages) <= 1:
-        return messages
-    system_msg = messages[0]
-    conv_msgs = messages[1:]
-    if len(conv_msgs) <= n:
-        return [system_msg] + conv_msgs
+def parse_temperatures(text):
+    """把“0.3, 0.7, 1.1”这样的输入解析成温度列表（0~2 之间，最多 MAX_CANDIDATES 个）。"""
+    temps = []
+    for part in text.replace("，", ",").split(","):
+        try:
+            temps.append(min(max(float(part), 0.0), 2.0))
+        except ValueError:
+            continue
+    return temps[:MAX_CANDIDATES] or [0.7]
+
+@st.cache_resource
+def get_metrics_recorder():
+    """整个进程共用一个指标缓冲，攒够一批再写文件。"""
+    return TurnMetricsRecorder()
+
+@st.cache_resource
+def get_target_pool():
+    """整个进程共用一个目标池（多 key / 多接口地址），见 llm_balancer.py。"""
+    if cassette_mode() == "replay":
+        # 回放时不读取 st.secrets，没有 secrets.toml 的 CI 环境也能运行
+        return pool_from_secrets(REPLAY_SECRETS, DEFAULT_API_BASE)
+    return pool_from_secrets(st.secrets["openai"], DEFAULT_API_BASE)
+
+def launch_job(job):
+    """创建 LLM，交给后台线程调用。"""
+    callback_manager = CallbackManager([StreamJobCallbackHandler(job)])
+    # 离线测试时可通过 LLM_CASSETTE_MODE 切换到录制 / 回放（见 llm_client.py）
+    llm = create_chat_llm(
+        pool=get_target_pool(),
+        temperature=job.temperature,
+        max_tokens=job.max_tokens,
+        callback_manager=callback_manager
+    )
+    threading.Thread(target=job.run, args=(llm,), daemon=True).start()
+    return job
+
+def prepare_turn(prompt, queued_prompts=(), answer_pending=False):
+    """分词并准备好传给模型的上下文，返回 QueuedTurn。
+    queued_prompts：排在这一轮前面、还没有发送的问题；answer_pending：是否有回答正在生成。"""
+    # 发送时的 messages = 当前历史 +（正在生成的回答）+ 前面排队的各轮（问题 + 回答）+ 本轮问题；
+    # 还没有生成的回答用它将来在 messages 里的下标占位
+    messages = list(st.session_state.messages)
+    if answer_pending:
+        messages.append(len(messages))
+    for queued in queued_prompts:
+        messages.append(HumanMessage(content=queued))
+        messages.append(len(messages))
+    expected_len = len(messages)
+    messages.append(HumanMessage(content=prompt))
+
+    # 只传“系统消息 + 最近 CONTEXT_WINDOW 条”给模型（见 chat_core.py）
+    context = get_model_context(messages, n=CONTEXT_WINDOW)
+
+    # 发送前压缩：只改传给模型的副本，st.session_state.messages 保持原样。
+    # 只压缩用户消息时，占位的回答不影响结果，入队时就可以压缩好
+    saved = 0
+    if COMPRESS_INPUT and COMPRESS_CONFIG.human_only:
+        context, saved = compress_context(context, COMPRESS_CONFIG)
+    elif COMPRESS_INPUT:
+        saved = None
+    return QueuedTurn(prompt, count_tokens(prompt), context, saved, expected_len)
+
+def launch_turn(turn):
+    """保存用户消息，并在后台线程里开始流式生成 AI 回复（对比模式下同时生成多个）。"""
+    # 前面的轮次有变化（出错没有回答 / 取消了排在前面的问题），按当前历史重新准备
+    if len(st.session_state.messages) != turn.expected_len:
+        turn = prepare_turn(turn.prompt)
+
+    # (a) 保存用户消息
+    st.session_state.messages.append(HumanMessage(content=turn.prompt))
+    st.session_state.tokens.append(turn.tokens)
+
+    # 已上传文档时，问题针对文档回答（map-reduce），不使用对话上下文
+    if st.session_state.attachment is not None:
+        job = DocQAJob(turn.prompt, st.session_state.attachment, get_target_pool())
+        st.session_state.stream_jobs = [launch_job(job)]
+        return
+
+    # (b) 把占位的下标换成已经生成好的回答；
+    #     上下文 token 数直接由已保存的每条消息 token 数相加，不再重新分词
+    context_for_llm = [
+        st.session_state.messages[m] if isinstance(m, int) else m for m in turn.context
+    ]
+    conv_tokens = sum(
+        st.session_state.tokens[-(len(context_for_llm) - 1):]
+    ) if len(context_for_llm) > 1 else 0
+    # tokens[0] 只是系统消息的占位 0；系统提示词另外计入，与 api_server / batch_runner 的统计口径一致
+    st.session_state.context_tokens = count_tokens(context_for_llm[0].content) + conv_tokens
+
+    # (c) 入队时没能压缩的（AI 回复也参与压缩），现在压缩
+    saved = turn.saved
+    if saved is None:
+        context_for_llm, saved = compress_context(context_for_llm, COMPRESS_CONFIG)
+    if COMPRESS_INPUT:
+        st.session_state.saved_tokens[len(st.session_state.messages) - 1] = saved
+        st.session_state.context_tokens -= saved
+
+    # (d) 普通模式 1 个候选；对比模式按温度列表同时发出 K 个请求
+    if st.session_state.get("compare_mode", False):
+        temps = parse_temperatures(st.session_state.get("compare_temps", ""))
+    else:
+        temps = [0.7]
+    jobs = [StreamJob(context_for_llm, t) for t in temps]
+    for job in jobs:
+        job.prompt_tokens = st.session_state.context_tokens
+    st.session_state.stream_jobs = [launch_job(job) for job in jobs]
+
+def start_turn(prompt):
+    """空闲时提交的问题：立即发送。"""
+    launch_turn(prepare_turn(prompt))
+
+def queue_turn(prompt):
+    """生成过程中提交的问题：立即分词、准备上下文并排到队尾，前面的回答结束后自动发送。"""
+    queue = st.session_state.turn_queue
+    queue.append(prepare_turn(prompt, [t.prompt for t in queue],
+                              answer_pending=bool(st.session_state.stream_jobs)))
+
+def start_queued_turn():
+    """当前没有进行中的生成时，发送队列里的下一个问题。"""
+    if st.session_state.turn_queue and not st.session_state.stream_jobs:
+        launch_turn(st.session_state.turn_queue.pop(0))
+
+def record_turn(job, completion_tokens, candidates):
+    """把这一轮的指标交给进程内的记录器（见 turn_metrics.py）。"""
+    if not RECORD_METRICS:
+        return
+    turn_index = len(st.session_state.messages) - 1  # 本轮用户消息的下标
+    if isinstance(job, DocQAJob):
+        mode = "doc_qa"
     else:
-        return [system_msg] + conv_msgs[-n:]
+        mode = "compare" if candidates > 1 else "chat"
+    get_metrics_recorder().record(
+        job.started_at,
+        session_id=st.session_state.session_id,
+        turn_index=turn_index,
+        mode=mode,
+        context_window=CONTEXT_WINDOW,
+        context_messages=len(job.context or []),
+        prompt_tokens=job.prompt_tokens,
+        prompt_tokens_saved=st.session_state.saved_tokens.get(turn_index, 0),
+        completion_tokens=completion_tokens,
+        ttft_s=job.first_token_at - job.started_at if job.first_token_at is not None else None,
+        duration_s=(job.finished_at or time.time()) - job.started_at,
+        temperature=job.temperature,
+        candidates=candidates,
+        compressed=COMPRESS_INPUT,
+        cancelled=job.cancelled,
+        truncated=job.truncation is not None,
+        error=job.error is not None,
+    )
+
+def finish_turn(job):
+    """将最终 AI 内容存入会话；调用出错时记下错误（显示在这一轮的问题下面），不保存回答。
+    两种情况下都会紧接着发送排队的问题。"""
+    # 对比模式下保留其中一个，其余仍在生成的候选直接停止
+    candidates = len(st.session_state.stream_jobs)
+    for other in st.session_state.stream_jobs:
+        other.stop_event.set()
+    st.session_state.stream_jobs = []
+    if job.error is not None:
+        record_turn(job, job.n_tokens, candidates)
+        st.session_state.turn_errors[len(st.session_state.messages) - 1] = str(job.error)
+        start_queued_turn()
+        return
+    ai_content = job.partial_text
+    ai_tokens = count_tokens(ai_content)
+    record_turn(job, ai_tokens, candidates)
+    if job.truncation is not None:
+        st.session_state.truncations[len(st.session_state.messages)] = job.truncation
+    st.session_state.messages.append(AIMessage(content=ai_content))
+    st.session_state.tokens.append(ai_tokens)
+    # 有排队的问题时紧接着发送，不用等下一次交互
+    start_queued_turn()
+
+def discard_turn(jobs):
+    """对比模式下所有候选都失败：与单个回答出错时一样，记下错误并发送排队的问题。"""
+    st.session_state.stream_jobs = []
+    record_turn(jobs[0], jobs[0].n_tokens, len(jobs))
+    errors = dict.fromkeys(str(job.error) for job in jobs)  # 去重，保持顺序
+    st.session_state.turn_errors[len(st.session_state.messages) - 1] = "；".join(errors)
+    start_queued_turn()
+
+def rerun_chat_area():
+    """只重跑聊天区 fragment；若当前是整页运行（无法只重跑 fragment），则整页重跑一次——
+    下一次整页运行时仍有回答在生成，聊天区会改由 run_every 定时重跑（见 chat_area）。"""
+    try:
+        st.rerun(scope="fragment")
+    except StreamlitAPIException:
+        st.rerun()
 
 ########################################
-# 8) 用户输入
+# 7) 侧边栏：对比模式设置（放在单独的 fragment 里，修改时不打断正在进行的生成）
 ########################################
-prompt = st.chat_input("请输入内容...")
+@st.fragment
+def compare_settings():
+    st.toggle("对比模式", key="compare_mode",
+              help="同一上下文同时生成多个候选回答，选择其中一个保留到对话中。")
+    st.text_input("候选温度（逗号分隔）", value="0.3, 0.7, 1.1", key="compare_temps",
+                  disabled=not st.session_state.get("compare_mode", False))
 
-if prompt:
-    # 每次新输入时重置停止标志 & partial_text
-    st.session_state.stop_requested = False
-    st.session_state.partial_text = ""
+@st.fragment(run_every=5)
+def pool_metrics():
+    """每个 key / 接口地址的在途请求、延迟、吞吐，以及最近的路由决策。"""
+    pool = get_target_pool()
+    with st.expander("负载均衡", expanded=False):
+        st.dataframe(pool.snapshot(), hide_index=True)
+        st.caption("最近的路由决策")
+        st.dataframe(
+            [
+                {"时间": time.strftime("%H:%M:%S", time.localtime(ts)),
+                 "目标": name, "原因": reason, "得分": score}
+                for ts, name, reason, score in pool.recent_decisions()
+            ],
+            hide_index=True,
+        )
 
-    # (a) 保存用户消息
-    user_msg = HumanMessage(content=prompt)
-    st.session_state.messages.append(user_msg)
-    user_tokens = count_tokens(prompt)
-    st.session_state.tokens.append(user_tokens)
-
-    # (b) 在界面显示用户消息
-    with st.chat_message("user"):
-        st.write(prompt)
+@st.fragment
+def attachment_settings():
+    """上传文档后，提问将针对文档回答；文件只落盘一次，不放进 session_state。"""
+    uploaded = st.file_uploader("上传文档（针对文档提问）",
+                                type=["txt", "md", "log", "py", "csv", "json"])
+    attachment = st.session_state.attachment
+    if uploaded is None:
+        st.session_state.attachment = None
+        return
+    if attachment is None or attachment["file_id"] != uploaded.file_id:
+        path, file_hash = doc_qa.store_upload(uploaded)
+        attachment = {"name": uploaded.name, "path": path, "hash": file_hash,
+                      "file_id": uploaded.file_id}
+        st.session_state.attachment = attachment
+    chunks = doc_qa.load_chunks(attachment["path"], attachment["hash"])
+    st.caption(f"{attachment['name']}：{len(chunks)} 个片段，"
+               f"共 {sum(c[2] for c in chunks)} tokens")
+
+with st.sidebar:
+    compare_settings()
+    attachment_settings()
+    pool_metrics()
+
+########################################
+# 8) 聊天区 fragment：输入框 + 流式气泡 + 停止按钮 + 排队中的问题
+########################################
+def render_stream_text(job):
+    """显示流式生成中的内容。"""
+    if not job.partial_text:
+        st.write(job.status)
+    elif USE_DELTA_STREAM:
+        delta_stream(job.partial_text, job.cursor)
+    else:
+        st.write(job.partial_text)
+
+def render_single(job):
+    """普通模式：一个流式气泡 + 停止按钮。"""
+    with st.chat_message("assistant"):
+        render_stream_text(job)
+        if st.button("停止输出"):
+            job.stop_event.set()
+
+def render_candidates(jobs):
+    """对比模式：K 列并排流式输出，每列可单独停止，生成结束后可保留到对话中。"""
+    with st.chat_message("assistant"):
         if SHOW_TOKENS:
             st.write(
-                f"<p class='token-info'>[用户消耗 {user_tokens} tokens]</p>",
+                f"<p class='token-info'>[上下文 {st.session_state.context_tokens} tokens，"
+                f"{len(jobs)} 个候选共用]</p>",
                 unsafe_allow_html=True
             )
+        for i, (col, job) in enumerate(zip(st.columns(len(jobs)), jobs)):
+            with col:
+                st.markdown(f"**候选 {i + 1}**（温度 {job.temperature}）")
+                if job.error is not None:
+                    st.error(f"生成失败：{job.error}")
+                elif job.done:
+                    st.write(job.partial_text)
+                else:
+                    render_stream_text(job)
+                st.caption(job.stats_text())
+                if not job.done:
+                    if st.button("停止", key=f"stop_candidate_{i}"):
+                        job.stop_event.set()
+                elif job.error is None:
+                    if st.button("保留此回答", key=f"keep_candidate_{i}"):
+                        finish_turn(job)
+                        st.rerun()
 
-    # (c) 只传“系统消息 + 最近3条”给模型
-    context_for_llm = get_model_context(st.session_state.messages, n=3)
-
-    # (d) 流式输出 AI 回复
-    with st.chat_message("assistant"):
-        stream_placeholder = st.empty()  # 用于承载流式文本
-        btn_container = st.empty()       # 用于放置“停止输出”按钮
-
-        callback_manager = CallbackManager([
-            StreamlitStreamingCallbackHandler(stream_placeholder)
-        ])
-        llm = ChatOpenAI(
-            openai_api_key=st.secrets["openai"]["api_key"],
-            model_name="deepseek-chat",
-            openai_api_base='https://api.deepseek.com',
-            temperature=0.7,
-            max_tokens=1024,
-            streaming=True,
-            callback_manager=callback_manager
-        )
+def render_queue():
+    """排队中的问题：显示为待发送的气泡，可以单独取消。"""
+    for turn in list(st.session_state.turn_queue):
+        with st.chat_message("user"):
+            st.write(turn.prompt)
+            st.caption(f"排队中，当前回答结束后发送（{turn.tokens} tokens）")
+            if st.button("取消", key=f"cancel_queued_{turn.turn_id}"):
+                st.session_state.turn_queue.remove(turn)
 
-        try:
-            with st.spinner("AI 正在思考..."):
-                # 在模型调用前先渲染“停止输出”按钮
-                stop_button = btn_container.button("停止输出")
-                if stop_button:
-                    st.session_state.stop_requested = True
+# 整页运行时仍有回答在生成（比如浏览器重连触发了整页运行），此时无法从 fragment 里
+# 只重跑 fragment，改由 run_every 定时重跑聊天区，避免之后每次轮询都整页重跑
+AUTO_POLL = any(not job.done for job in st.session_state.stream_jobs)
 
-                # 真正开始调用模型，流式生成
-                ai_response = llm(context_for_llm)
-                ai_content = ai_response.content
+@st.fragment(run_every=POLL_INTERVAL if AUTO_POLL else None)
+def chat_area(history_len, auto_poll):
+    """交互时只重跑这一段，不会重新画 CSS、历史记录等静态内容。
+    auto_poll 为 True 时由 run_every 定时重跑，自己不再 sleep + rerun。"""
+    jobs = st.session_state.stream_jobs
 
-        except StopStreamingException:
-            # 若中断，则只保留现有partial_text
-            ai_content = st.session_state.partial_text
+    # (a) 用户输入：生成过程中 / 对比模式尚未选定回答时提交的问题先排队
+    prompt = st.chat_input("请输入内容...")
+    if prompt:
+        if jobs or st.session_state.turn_queue:
+            queue_turn(prompt)
+        else:
+            start_turn(prompt)
+    # 空闲但队列里还有问题时（正常情况下结束一轮时已经发出），发送下一个
+    start_queued_turn()
+    jobs = st.session_state.stream_jobs
 
-        # 回复完成后，清空停止按钮
-        btn_container.empty()
+    # (b) 画出整页运行之后新增的消息
+    for i in range(history_len, len(st.session_state.messages)):
+        render_message(st.session_state.messages[i], st.session_state.tokens[i],
+                       st.session_state.saved_tokens.get(i, 0),
+                       st.session_state.truncations.get(i),
+                       st.session_state.turn_errors.get(i))
 
-    # (e) 将最终 AI 内容存入会话
-    ai_msg = AIMessage(content=ai_content)
-    st.session_state.messages.append(ai_msg)
-    ai_tokens = count_tokens(ai_content)
-    st.session_state.tokens.append(ai_tokens)
+    if not jobs:
+        if auto_poll:
+            st.rerun()  # 整页刷新一次，停掉定时重跑
+        return
 
-    # (f) 最后把完整内容 & token 数写回 placeholder
-    if SHOW_TOKENS:
-        stream_placeholder.write(
-            f"{ai_content}\n\n<p class='token-info'>[AI消耗 {ai_tokens} tokens]</p>",
-            unsafe_allow_html=True
-        )
+    if len(jobs) == 1:
+        # (c) 生成已结束：存入会话后整页刷新一次，让它进入上面的静态历史记录，
+        #     之后的轮询只重画正在生成的气泡
+        if jobs[0].done:
+            finish_turn(jobs[0])
+            st.rerun()
+        # (d) 流式输出中：显示当前内容 + 停止按钮
+        render_single(jobs[0])
     else:
-        stream_placeholder.write(ai_content)
+        # (e) 对比模式：所有候选都失败时放弃这一轮，不必再等用户选择
+        if all(job.done and job.error is not None for job in jobs):
+            discard_turn(jobs)
+            st.rerun()
+        # 所有候选都结束后停止刷新，等待用户选择保留哪一个
+        render_candidates(jobs)
+
+    # (f) 排队中的问题
+    render_queue()
+    if len(jobs) > 1 and all(job.done for job in jobs):
+        if auto_poll:
+            st.rerun()  # 等待用户选择时不需要定时重跑
+        return
+    if auto_poll:
+        return
+
+    # 稍后再刷新
+    time.sleep(POLL_INTERVAL)
+    rerun_chat_area()
+
+chat_area(history_len, AUTO_POLL)
@@ -0,0 +1,304 @@
+# 文件名：batch_runner.py
+#
+# 无界面的批量运行：读取一个 JSONL（每行一段对话），按与 app_v8.py 相同的流程调用模型：
+# 补系统提示词 -> get_model_context 取最近 N 条 ->（发送前压缩）-> count_tokens 统计，
+# 回答过程中同样检测重复循环 / 低熵输出（见 degenerate.py）。
+#
+# 输入每行：{"id": "可选", "messages": [{"role": "user", "content": "..."}, ...], "temperature": 可选}
+#   输入里已有的 assistant 回复原样保留；每条后面没有回复的 user 消息都会依次生成一条回复，
+#   所以既可以是“历史 + 最后一个问题”，也可以是只有若干个问题、像界面里一样逐轮对话。
+#
+# 输出：每段对话完成后立即追加一行到输出文件（对话 + 每轮统计）；失败的写到 <输出>.errors。
+# 中断后用同样的命令重跑即可：输出文件里已有的对话会被跳过（失败的会重试）。
+#
+# 用法：
+#   python batch_runner.py prompts.jsonl results.jsonl --concurrency 16 --rps 5
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+
+import toml
+from langchain.schema import AIMessage, HumanMessage
+
+from chat_core import CONTEXT_WINDOW, count_tokens, get_model_context, parse_messages
+from degenerate import DegenerationMonitor
+from input_compress import CompressConfig, compress_context
+from llm_balancer import pool_from_secrets
+from llm_client import (DEFAULT_API_BASE, MESSAGE_ROLES, REPLAY_SECRETS, astream_chat, cassette_mode,
+                        close_http_clients, make_http_clients)
+from turn_metrics import TurnMetricsRecorder
+
+########################################
+# 1) 断点续跑 & 限速
+########################################
+def load_checkpoint(output_path):
+    """返回输出文件里已完成的对话 id；上次中断时写了一半的最后一行会被截掉。"""
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    good_size = 0
+    with open(output_path, "rb") as f:
+        for line in f:
+            try:
+                done.add(json.loads(line)["id"])
+            except (ValueError, KeyError):
+                break
+            good_size += len(line)
+    if good_size != os.path.getsize(output_path):
+        with open(output_path, "r+b") as f:
+            f.truncate(good_size)
+    return done
+
+class RateLimiter:
+    """令牌桶：平均每秒最多发起 rate 个请求，允许 burst 个突发；rate 为 None 表示不限速。"""
+    def __init__(self, rate=None, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._last = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        if self.rate is None:
+            return
+        async with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                self._tokens = 0
+                self._last = time.monotonic()
+            else:
+                self._tokens -= 1
+
+########################################
+# 2) 单段对话
+########################################
+def iter_conversations(input_path, done_ids):
+    """逐行读取输入，跳过已完成的对话；不把整个文件读进内存。"""
+    with open(input_path, encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                item = json.loads(line)
+            except ValueError:
+                item = None  # 交给 run_conversation 报错，记到失败记录里
+            conv_id = str(item.get("id", f"line-{line_no}")) if isinstance(item, dict) else f"line-{line_no}"
+            if conv_id not in done_ids:
+                yield conv_id, item
+
+class BatchRunner:
+    def __init__(self, pool, context_window=CONTEXT_WINDOW, compress_config=None,
+                 temperature=0.7, max_tokens=1024, rate_limiter=None, recorder=None,
+                 detect_degenerate=True):
+        self.pool = pool
+        self.context_window = context_window
+        self.compress_config = compress_config  # None 表示不压缩
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.recorder = recorder                # TurnMetricsRecorder；None 表示不记录
+        self.detect_degenerate = detect_degenerate
+        self.http_clients = make_http_clients(pool)
+
+    async def run_turn(self, conv_id, messages, temperature):
+        """对 messages（最后一条是用户消息）生成一条回复，返回 (回复, 本轮统计)。"""
+        context = get_model_context(messages, n=self.context_window)
+        saved = 0
+        if self.compress_config is not None:
+            context, saved = compress_context(context, self.compress_config)
+        prompt_tokens = sum(count_tokens(m.content) for m in context)
+
+        await self.rate_limiter.acquire()
+        monitor = DegenerationMonitor() if self.detect_degenerate else None
+        started_wall, started = time.time(), time.monotonic()
+        first_token_at = None
+        parts = []
+        finish_reason = "stop"
+        upstream = astream_chat(context, pool=self.pool, http_clients=self.http_clients,
+                                temperature=temperature, max_tokens=self.max_tokens)
+        try:
+            async for text in upstream:
+                first_token_at = first_token_at or time.monotonic()
+                parts.append(text)
+                if monitor is not None and monitor.feed(text) is not None:
+                    finish_reason = "degenerate"
+                    break
+        finally:
+            await upstream.aclose()
+        content = "".join(parts)
+
+        stats = {
+            "prompt_tokens": prompt_tokens,
+            "prompt_tokens_saved": saved,
+            "completion_tokens": count_tokens(content),
+            "ttft_s": round(first_token_at - started, 3) if first_token_at is not None else None,
+            "duration_s": round(time.monotonic() - started, 3),
+            "finish_reason": finish_reason,
+        }
+        if self.recorder is not None:
+            self.recorder.record(
+                started_wall,
+                session_id=conv_id,
+                turn_index=len(messages) - 1,
+                mode="batch",
+                context_window=self.context_window,
+                context_messages=len(context),
+                prompt_tokens=prompt_tokens,
+                prompt_tokens_saved=saved,
+                completion_tokens=stats["completion_tokens"],
+                ttft_s=stats["ttft_s"],
+                duration_s=stats["duration_s"],
+                temperature=temperature,
+                candidates=1,
+                compressed=self.compress_config is not None,
+                cancelled=False,
+                truncated=finish_reason == "degenerate",
+                error=False,
+            )
+        return content, stats
+
+    async def run_conversation(self, conv_id, item):
+        """逐轮生成：每条后面没有回复的用户消息生成一条回复，并放进后续轮次的上下文。"""
+        given = parse_messages(item)
+        temperature = float(item.get("temperature", self.temperature))
+        messages = [given[0]]
+        turns = []
+        for i, msg in enumerate(given[1:], 1):
+            messages.append(msg)
+            next_is_reply = i + 1 < len(given) and isinstance(given[i + 1], AIMessage)
+            if isinstance(msg, HumanMessage) and not next_is_reply:
+                content, stats = await self.run_turn(conv_id, messages, temperature)
+                messages.append(AIMessage(content=content))
+                turns.append(stats)
+        return {
+            "id": conv_id,
+            "messages": [{"role": MESSAGE_ROLES[m.type], "content": m.content} for m in messages],
+            "turns": turns,
+        }
+
+    async def close(self):
+        await close_http_clients(self.http_clients)
+
+########################################
+# 3) 并发调度 & 汇总
+########################################
+async def run_batch(runner, conversations, output_path, errors_path, concurrency):
+    """concurrency 个 worker 共用一个对话迭代器；每段对话完成后立即写出一行。"""
+    results = []  # 每段成功对话的各轮统计
+    n_errors = 0
+    with open(output_path, "a", encoding="utf-8") as out, \
+            open(errors_path, "a", encoding="utf-8") as errors:
+
+        async def worker():
+            nonlocal n_errors
+            for conv_id, item in conversations:
+                try:
+                    result = await runner.run_conversation(conv_id, item)
+                except Exception as e:
+                    n_errors += 1
+                    errors.write(json.dumps({"id": conv_id, "error": str(e)}, ensure_ascii=False) + "\n")
+                    errors.flush()
+                    continue
+                out.write(json.dumps(result, ensure_ascii=False) + "\n")
+                out.flush()
+                results.append(result["turns"])
+                if len(results) % 100 == 0:
+                    print(f"已完成 {len(results)} 段对话", file=sys.stderr)
+
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return results, n_errors
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+def print_summary(results, n_errors, elapsed):
+    turns = [t for conv in results for t in conv]
+    completion = sum(t["completion_tokens"] for t in turns)
+    prompt = sum(t["prompt_tokens"] for t in turns)
+    print(f"{len(results)} 段对话（失败 {n_errors}），{len(turns)} 次调用，用时 {elapsed:.1f}s")
+    if not turns:
+        return
+    print(f"吞吐：{len(results) / elapsed:.2f} 对话/秒，{len(turns) / elapsed:.2f} 调用/秒，"
+          f"{completion / elapsed:.0f} 输出 tokens/秒")
+    print(f"tokens：输入 {prompt}（压缩节省 {sum(t['prompt_tokens_saved'] for t in turns)}），输出 {completion}")
+    ttfts = [t["ttft_s"] for t in turns if t["ttft_s"] is not None]
+    if ttfts:
+        print(f"首字延迟：p50 {statistics.median(ttfts):.2f}s，p95 {percentile(ttfts, 95):.2f}s")
+    durations = [t["duration_s"] for t in turns]
+    print(f"单次调用用时：p50 {statistics.median(durations):.2f}s，p95 {percentile(durations, 95):.2f}s")
+    degenerate = sum(1 for t in turns if t["finish_reason"] == "degenerate")
+    if degenerate:
+        print(f"因重复 / 低熵输出提前截断：{degenerate} 次")
+
+########################################
+# 4) 命令行入口
+########################################
+def main():
+    parser = argparse.ArgumentParser(description="按 app_v8 的流程批量运行 JSONL 中的对话")
+    parser.add_argument("input", help="输入 JSONL，每行一段对话")
+    parser.add_argument("output", help="输出 JSONL；已存在时跳过其中已完成的对话（断点续跑）")
+    parser.add_argument("--errors", help="失败记录文件（默认为 <output>.errors）")
+    parser.add_argument("--secrets", default=".streamlit/secrets.toml",
+                        help="与 Streamlit 应用共用的 secrets.toml（读取其中的 [openai] 配置）")
+    parser.add_argument("--concurrency", type=int, default=8, help="同时进行的对话数")
+    parser.add_argument("--rps", type=float, default=None, help="每秒最多发起的请求数（默认不限）")
+    parser.add_argument("--burst", type=int, default=1, help="限速时允许的突发请求数")
+    parser.add_argument("--context-window", type=int, default=CONTEXT_WINDOW,
+                        help="传给模型的最近对话条数")
+    parser.add_argument("--temperature", type=float, default=0.7)
+    parser.add_argument("--max-tokens", type=int, default=1024)
+    parser.add_argument("--no-compress", action="store_true",
+                        help="关闭发送前的输入压缩（见 input_compress.py）")
+    parser.add_argument("--no-degenerate-check", action="store_true",
+                        help="关闭重复循环 / 低熵输出检测（见 degenerate.py）")
+    parser.add_argument("--metrics", action="store_true",
+                        help="同时把每轮指标写入 Parquet（见 turn_metrics.py）")
+    args = parser.parse_args()
+    if args.context_window < 1:
+        parser.error("--context-window 必须是正整数")
+
+    if cassette_mode() == "replay":
+        openai_secrets = REPLAY_SECRETS  # 回放不联网，不需要 secrets.toml
+    else:
+        openai_secrets = toml.load(args.secrets)["openai"]
+    pool = pool_from_secrets(openai_secrets, DEFAULT_API_BASE)
+    done_ids = load_checkpoint(args.output)
+    if done_ids:
+        print(f"跳过已完成的 {len(done_ids)} 段对话", file=sys.stderr)
+
+    recorder = TurnMetricsRecorder() if args.metrics else None
+    runner = BatchRunner(
+        pool,
+        context_window=args.context_window,
+        compress_config=None if args.no_compress else CompressConfig(),
+        temperature=args.temperature,
+        max_tokens=args.max_tokens,
+        rate_limiter=RateLimiter(args.rps, args.burst),
+        recorder=recorder,
+        detect_degenerate=not args.no_degenerate_check,
+    )
+
+    async def run():
+        try:
+            return await run_batch(runner, iter_conversations(args.input, done_ids), args.output,
+                                   args.errors or f"{args.output}.errors", args.concurrency)
+        finally:
+            await runner.close()
+
+    started = time.monotonic()
+    results, n_errors = asyncio.run(run())
+    if recorder is not None:
+        recorder.flush()
+    print_summary(results, n_errors, time.monotonic() - started)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+# 文件名：bench_api_server.py
+#
+# api_server.py 的并发流式吞吐基准：
+#   - 子进程 1：本地模拟的上游（OpenAI 兼容 SSE，每个 token 间隔固定时间）
+#   - 子进程 2：api_server，目标池指向模拟上游
+#   - 主进程：同时发起 N 个流式请求，统计吞吐和首字延迟
+#
+# 用法：python bench_api_server.py --streams 500 --concurrency 500
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import socket
+import statistics
+import time
+
+import aiohttp
+from aiohttp import web
+
+########################################
+# 1) 模拟上游 & 被测服务
+########################################
+def run_mock_upstream(port, n_tokens, token_delay):
+    async def chat(request):
+        body = await request.json()
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for i in range(n_tokens):
+            chunk = {
+                "id": "mock", "object": "chat.completion.chunk", "created": 0, "model": body["model"],
+                "choices": [{"index": 0, "delta": {"content": f"词{i} "}, "finish_reason": None}],
+            }
+            await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+            await asyncio.sleep(token_delay)
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+    app = web.Application()
+    app.router.add_post("/chat/completions", chat)
+    web.run_app(app, host="127.0.0.1", port=port, print=None)
+
+def run_api_server(port, upstream_port):
+    from api_server import create_app
+    from llm_balancer import pool_from_secrets
+
+    pool = pool_from_secrets(
+        {"targets": [{"api_key": "mock", "base_url": f"http://127.0.0.1:{upstream_port}"}]},
+        f"http://127.0.0.1:{upstream_port}",
+    )
+    web.run_app(create_app(pool), host="127.0.0.1", port=port, print=None)
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+async def wait_for_port(port, timeout=20.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError(f"端口 {port} 没有启动")
+
+########################################
+# 2) 压测客户端
+########################################
+async def one_stream(session, url, semaphore):
+    async with semaphore:
+        started = time.monotonic()
+        first_token = None
+        n_chunks = 0
+        async with session.post(url, json={
+            "model": "deepseek-chat",
+            "stream": True,
+            "messages": [{"role": "user", "content": "你好"}],
+        }) as response:
+            async for line in response.content:
+                if not line.startswith(b"data: ") or line.startswith(b"data: [DONE]"):
+                    continue
+                delta = json.loads(line[6:])["choices"][0]["delta"]
+                if delta.get("content"):
+                    n_chunks += 1
+                    if first_token is None:
+                        first_token = time.monotonic()
+        return first_token - started, time.monotonic() - started, n_chunks
+
+async def run_load(port, n_streams, concurrency):
+    url = f"http://127.0.0.1:{port}/v1/chat/completions"
+    semaphore = asyncio.Semaphore(concurrency)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        started = time.monotonic()
+        results = await asyncio.gather(*[one_stream(session, url, semaphore) for _ in range(n_streams)])
+        elapsed = time.monotonic() - started
+    return results, elapsed
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+########################################
+# 3) 入口
+########################################
+def main():
+    parser = argparse.ArgumentParser(description="api_server 并发流式吞吐基准")
+    parser.add_argument("--streams", type=int, default=500, help="总请求数")
+    parser.add_argument("--concurrency", type=int, default=500, help="同时进行的流数")
+    parser.add_argument("--tokens", type=int, default=100, help="每个回答的 token 数")
+    parser.add_argument("--token-delay", type=float, default=0.02, help="模拟上游每个 token 的间隔（秒）")
+    args = parser.parse_args()
+
+    upstream_port, server_port = free_port(), free_port()
+    processes = [
+        multiprocessing.Process(target=run_mock_upstream,
+                                args=(upstream_port, args.tokens, args.token_delay), daemon=True),
+        multiprocessing.Process(target=run_api_server, args=(server_port, upstream_port), daemon=True),
+    ]
+    for p in processes:
+        p.start()
+    try:
+        asyncio.run(wait_for_port(upstream_port))
+        asyncio.run(wait_for_port(server_port))
+        results, elapsed = asyncio.run(run_load(server_port, args.streams, args.concurrency))
+    finally:
+        for p in processes:
+            p.terminate()
+
+    ttfts = [r[0] for r in results]
+    durations = [r[1] for r in results]
+    chunks = sum(r[2] for r in results)
+    ideal = args.tokens * args.token_delay
+    print(f"{args.streams} 个流，并发 {args.concurrency}，总用时 {elapsed:.2f}s")
+    print(f"吞吐：{args.streams / elapsed:.1f} 流/秒，{chunks / elapsed:.0f} 分块/秒")
+    print(f"首字延迟：p50 {percentile(ttfts, 50) * 1000:.0f}ms，p95 {percentile(ttfts, 95) * 1000:.0f}ms")
+    print(f"单流用时：p50 {statistics.median(durations):.2f}s，p95 {percentile(durations, 95):.2f}s"
+          f"（上游理想用时 {ideal:.2f}s）")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+# 文件名：chat_core.py
+#
+# 与界面无关的对话逻辑：系统提示词、token 统计、上下文窗口。
+# app_v8.py 和无界面的 api_server.py / batch_runner.py 共用这里的实现，保证几处行为一致。
+
+import functools
+
+import tiktoken
+from langchain.schema import AIMessage, HumanMessage, SystemMessage
+
+SYSTEM_PROMPT = "你是一个乐于助人的AI助手。"
+
+# 传给模型的“最近N条”对话条数
+CONTEXT_WINDOW = 3
+
+########################################
+# 1) token 统计函数
+########################################
+@functools.lru_cache(maxsize=None)
+def get_encoding(model_name="deepseek-chat"):
+    """取得 tiktoken 编码器（按模型名缓存，避免每次统计都重新查找）。"""
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except Exception:
+        return tiktoken.get_encoding("cl100k_base")
+
+def count_tokens(text, model_name="deepseek-chat"):
+    return len(get_encoding(model_name).encode(text))
+
+########################################
+# 2) 函数：获取“系统消息 + 最近N条”
+########################################
+def get_model_context(messages, n=10):
+    """返回：SystemMessage + 最后 n 条 (Human/AIMessage)。"""
+    if len(messages) <= 1:
+        return messages
+    system_msg = messages[0]
+    conv_msgs = messages[1:]
+    if len(conv_msgs) <= n:
+        return [system_msg] + conv_msgs
+    else:
+        return [system_msg] + conv_msgs[-n:]
+
+########################################
+# 3) 解析 OpenAI 格式的 messages（api_server 的请求体、batch_runner 的每行输入）
+########################################
+ROLE_TO_MESSAGE = {"system": SystemMessage, "user": HumanMessage, "assistant": AIMessage}
+
+class BadRequest(Exception):
+    """请求体 / 输入行不合法（api_server 返回 400）。"""
+    pass
+
+def parse_messages(payload):
+    """把 OpenAI 格式的 messages 转成 LangChain 消息；没有系统消息时补上默认的系统提示词。"""
+    if not isinstance(payload, dict):
+        raise BadRequest("请求体必须是 JSON 对象")
+    raw_messages = payload.get("messages")
+    if not isinstance(raw_messages, list) or not raw_messages:
+        raise BadRequest("messages 必须是非空列表")
+    messages = []
+    for m in raw_messages:
+        if not isinstance(m, dict) or m.get("role") not in ROLE_TO_MESSAGE:
+            raise BadRequest(f"不支持的消息：{m!r}")
+        if not isinstance(m.get("content"), str):
+            raise BadRequest("content 必须是字符串")
+        messages.append(ROLE_TO_MESSAGE[m["role"]](content=m["content"]))
+    if not isinstance(messages[0], SystemMessage):
+        messages.insert(0, SystemMessage(content=SYSTEM_PROMPT))
+    return messages
@@ -0,0 +1,127 @@
+# 文件名：degenerate.py
+#
+# 流式输出的“退化”检测：模型陷入重复循环或只输出低信息量内容时尽早停止生成，
+# 不再为剩下的 max_tokens 付费、等待。逐 token 增量计算，每个流占用的内存是常数：
+#   1) 重复循环：对最近 n 个 token 做滚动哈希，记录窗口内每个 n-gram 上次出现的位置；
+#      如果连续很多个位置都在固定间隔 P 之前出现过，说明输出在以周期 P 重复
+#   2) 低熵停滞：最近一段 token 的分布熵过低（比如一直输出同一个符号 / 空白）
+
+import collections
+import math
+
+_MOD = (1 << 61) - 1
+_BASE = 1_000_003
+
+########################################
+# 1) 配置 & 异常
+########################################
+class MonitorConfig:
+    def __init__(self, ngram=6, window=512, min_cycles=3, min_repeat_tokens=48,
+                 entropy_window=64, min_entropy=1.0):
+        self.ngram = ngram                          # 滚动哈希覆盖的 token 数
+        self.window = window                        # 在最近多少个位置里找重复（也是最大周期）
+        self.min_cycles = min_cycles                # 至少重复几遍才算循环
+        self.min_repeat_tokens = min_repeat_tokens  # 重复部分至少多少 token 才算循环
+        self.entropy_window = entropy_window        # 计算熵的 token 窗口
+        self.min_entropy = min_entropy              # 低于该熵（bit）视为停滞
+
+class DegenerateOutputException(Exception):
+    """检测到退化输出时由回调抛出，用于中断上游流式生成。"""
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+########################################
+# 2) 监视器
+########################################
+class DegenerationMonitor:
+    """每个流一个；对每个新 token 调用 feed()，返回退化原因（正常时为 None）。"""
+    def __init__(self, config=None):
+        self.config = config or MonitorConfig()
+        n = self.config.ngram
+        self._drop_factor = pow(_BASE, n - 1, _MOD)  # 移出窗口的 token 对应的权重
+        self._recent = collections.deque(maxlen=n)   # 最近 n 个 token 的哈希
+        self._hash = 0
+        self._pos = 0
+        # 最近 window 个位置的 n-gram 哈希（环形），以及每个哈希最近一次出现的位置
+        self._ring = [None] * self.config.window
+        self._last_pos = {}
+        self._period = None
+        self._run = 0
+        # 熵统计：窗口内各 token 的出现次数，以及 sum(c * log2(c))
+        self._entropy_tokens = collections.deque()
+        self._counts = collections.Counter()
+        self._c_log_c = 0.0
+
+    def feed(self, token):
+        return self._feed_cycle(token) or self._feed_entropy(token)
+
+    def _feed_cycle(self, token):
+        cfg = self.config
+        h = hash(token) & 0xFFFFFFFF
+        if len(self._recent) == cfg.ngram:
+            self._hash = (self._hash - self._recent[0] * self._drop_factor) % _MOD
+        self._recent.append(h)
+        self._hash = (self._hash * _BASE + h) % _MOD
+        pos = self._pos
+        self._pos += 1
+        if len(self._recent) < cfg.ngram:
+            return None
+
+        # 环形缓冲里被覆盖的旧位置，从“最近出现位置”表里移除，保证内存不随长度增长
+        slot = pos % cfg.window
+        old = self._ring[slot]
+        if old is not None and self._last_pos.get(old) == pos - cfg.window:
+            del self._last_pos[old]
+        self._ring[slot] = self._hash
+
+        prev = self._last_pos.get(self._hash)
+        self._last_pos[self._hash] = pos
+        if prev is None:
+            self._period, self._run = None, 0
+            return None
+        period = pos - prev
+        if period == self._period:
+            self._run += 1
+        else:
+            self._period, self._run = period, 1
+        # run 个位置都与 period 之前相同，相当于已经重复了 run / period + 1 遍
+        repeated = self._run + cfg.ngram - 1
+        if repeated >= cfg.min_repeat_tokens and repeated >= period * (cfg.min_cycles - 1):
+            return f"检测到以 {period} 个 token 为周期的重复输出"
+        return None
+
+    def _feed_entropy(self, token):
+        cfg = self.config
+        self._add_count(token, +1)
+        self._entropy_tokens.append(token)
+        if len(self._entropy_tokens) > cfg.entropy_window:
+            self._add_count(self._entropy_tokens.popleft(), -1)
+        if len(self._entropy_tokens) < cfg.entropy_window:
+            return None
+        k = cfg.entropy_window
+        entropy = math.log2(k) - self._c_log_c / k
+        if entropy < cfg.min_entropy:
+            return f"最近 {k} 个 token 的熵只有 {entropy:.2f} bit，输出已停滞"
+        return None
+
+    def _add_count(self, token, delta):
+        c = self._counts[token]
+        self._c_log_c -= c * math.log2(c) if c else 0.0
+        c += delta
+        self._c_log_c += c * math.log2(c) if c else 0.0
+        if c:
+            self._counts[token] = c
+        else:
+            del self._counts[token]
+
+########################################
+# 3) 节省量估算
+########################################
+def estimate_savings(n_tokens, max_tokens, elapsed, first_token_delay=0.0):
+    """按已生成部分的平均速度，估算提前停止最多节省的 (token 数, 秒数)。
+    按最坏情况（循环一直持续到 max_tokens）的剩余额度计算，是上限而不是期望值。"""
+    saved_tokens = max(max_tokens - n_tokens, 0)
+    gen_time = max(elapsed - first_token_delay, 0.0)
+    per_token = gen_time / n_tokens if n_tokens else 0.0
+    return saved_tokens, saved_tokens * per_token
@@ -0,0 +1,56 @@
+# 文件名：delta_stream.py
+#
+# 流式输出用的自定义组件：每次只把“新增的文本片段”发给浏览器，由前端拼接显示。
+# 原来的 placeholder.write(partial_text) 每次都要重发整段回答，
+# 回答越长，websocket 流量和浏览器重绘都按长度的平方增长；这里只按长度线性增长。
+# 前端发现片段不连续（断线重连等）时会请求一次整段重发。
+# 前端把拼接后的全文按 markdown 渲染（每帧最多一次），和回答结束后 st.write 的显示一致。
+
+import os
+import uuid
+
+import streamlit.components.v1 as components
+
+_component = components.declare_component(
+    "delta_stream",
+    path=os.path.join(os.path.dirname(os.path.abspath(__file__)), "components", "delta_stream"),
+)
+
+class DeltaCursor:
+    """记录某一段流式文本已经发到浏览器的位置。每个流式回答用一个。"""
+    def __init__(self):
+        self.stream_id = uuid.uuid4().hex
+        self.sent_len = 0
+        self.seq = 0
+        self.need_full = True       # 首次渲染先发整段（通常是空串）
+        self.last_resync = None     # 已处理过的前端重发请求，避免重复处理
+
+def delta_stream(text, cursor):
+    """渲染流式文本 text；只把 cursor 之后新增的部分发给浏览器。"""
+    full = None
+    delta = ""
+    if cursor.need_full:
+        full = text
+        cursor.need_full = False
+    elif len(text) > cursor.sent_len:
+        delta = text[cursor.sent_len:]
+        cursor.seq += 1
+    cursor.sent_len = len(text)
+
+    request = _component(
+        stream_id=cursor.stream_id,
+        seq=cursor.seq,
+        delta=delta,
+        full=full,
+        key=f"delta_stream_{cursor.stream_id}",
+        default=None,
+    )
+
+    # 前端请求重新同步：下一次渲染时发整段
+    if (
+        request
+        and request.get("stream_id") == cursor.stream_id
+        and request.get("t") != cursor.last_resync
+    ):
+        cursor.last_resync = request.get("t")
+        cursor.need_full = True
@@ -0,0 +1,248 @@
+# 文件名：doc_qa.py
+#
+# 针对大文件提问：文件只落盘一次，之后用 mmap 按需读取，session_state 里只保存路径和哈希。
+#   1) 切块：按行扫描 mmap，用 chat_core 的分词器按 token 预算切成若干块，
+#      只记录每块的字节范围和 token 数；结果按“文件哈希 + 预算”缓存到磁盘
+#   2) 选块：按问题里的词（中文按双字、英文按单词）和各块的重合度挑出最相关的几块
+#   3) map：对选中的块并发提问（并发数有上限），每块得到一段要点
+#   4) reduce：把各块要点汇总成最终回答（由调用方流式输出）
+
+import asyncio
+import functools
+import hashlib
+import json
+import mmap
+import os
+import re
+import tempfile
+import threading
+
+from langchain.schema import HumanMessage, SystemMessage
+
+from chat_core import SYSTEM_PROMPT, get_encoding
+from llm_client import astream_chat, close_http_clients, make_http_clients
+
+UPLOAD_DIR = os.path.join(tempfile.gettempdir(), "llm_app_uploads")
+
+CHUNK_TOKENS = 1500    # 每块的 token 预算
+CHUNKS_VERSION = 2     # 切块规则变化时加一，磁盘上旧的切块缓存不再使用
+TOP_K_CHUNKS = 8       # 每个问题最多读几块
+MAX_PARALLEL = 4       # map 阶段同时进行的请求数上限
+
+NO_ANSWER = "无关"
+
+########################################
+# 1) 保存上传的文件
+########################################
+def store_upload(uploaded_file, upload_dir=UPLOAD_DIR):
+    """把上传的文件分块写到磁盘（文件名为内容哈希），返回 (路径, 哈希)。同一文件只保存一份。"""
+    os.makedirs(upload_dir, exist_ok=True)
+    digest = hashlib.sha256()
+    tmp_path = os.path.join(upload_dir, f".upload-{os.getpid()}-{id(uploaded_file)}")
+    uploaded_file.seek(0)
+    with open(tmp_path, "wb") as f:
+        for block in iter(functools.partial(uploaded_file.read, 1 << 20), b""):
+            digest.update(block)
+            f.write(block)
+    file_hash = digest.hexdigest()
+    path = os.path.join(upload_dir, file_hash)
+    os.replace(tmp_path, path)
+    return path, file_hash
+
+########################################
+# 2) 按 token 预算切块（只记录字节范围）
+########################################
+def _utf8_boundary(mm, pos, start):
+    """把切分点往前挪到 UTF-8 字符边界上。"""
+    while pos > start and (mm[pos] & 0xC0) == 0x80:
+        pos -= 1
+    return pos
+
+def _iter_pieces(mm, max_bytes):
+    """按行产出 (start, end) 字节范围；超长的行再按 max_bytes 切开。"""
+    size = len(mm)
+    pos = 0
+    while pos < size:
+        end = mm.find(b"\n", pos)
+        end = size if end == -1 else end + 1
+        while end - pos > max_bytes:
+            cut = _utf8_boundary(mm, pos + max_bytes, pos)
+            if cut == pos:
+                cut = pos + max_bytes
+            yield pos, cut
+            pos = cut
+        yield pos, end
+        pos = end
+
+def _split_piece(mm, start, end, n, max_tokens, encoding):
+    """token 数超过预算的片段（很长的一行里字符又很“密”）在 UTF-8 字符边界上对半切开，
+    直到每段都不超过预算；返回 [(start, end, tokens), ...]。"""
+    if n <= max_tokens or end - start <= 1:
+        return [(start, end, n)]
+    mid = _utf8_boundary(mm, (start + end) // 2, start)
+    if mid == start:
+        mid = (start + end) // 2
+    parts = []
+    for s, e in ((start, mid), (mid, end)):
+        count = len(encoding.encode_ordinary(mm[s:e].decode("utf-8", errors="replace")))
+        parts.extend(_split_piece(mm, s, e, count, max_tokens, encoding))
+    return parts
+
+def _chunk_mmap(mm, max_tokens, batch_size=2048):
+    encoding = get_encoding()
+    chunks = []                      # [(start, end, tokens), ...]
+    cur_start, cur_end, cur_tokens = 0, 0, 0
+    pieces = _iter_pieces(mm, max_tokens * 2)
+    while True:
+        batch = [p for _, p in zip(range(batch_size), pieces)]
+        if not batch:
+            break
+        texts = [mm[s:e].decode("utf-8", errors="replace") for s, e in batch]
+        # 一批行一起分词，比逐行调用快得多
+        counts = [len(t) for t in encoding.encode_ordinary_batch(texts)]
+        for (piece_start, piece_end), piece_n in zip(batch, counts):
+            # 片段按 max_tokens * 2 字节切的，字符很“密”时 token 数可能超过预算
+            for start, end, n in _split_piece(mm, piece_start, piece_end, piece_n, max_tokens, encoding):
+                if cur_tokens and cur_tokens + n > max_tokens:
+                    chunks.append((cur_start, cur_end, cur_tokens))
+                    cur_start, cur_tokens = start, 0
+                cur_end = end
+                cur_tokens += n
+    if cur_tokens:
+        chunks.append((cur_start, cur_end, cur_tokens))
+    return chunks
+
+@functools.lru_cache(maxsize=32)
+def load_chunks(path, file_hash, max_tokens=CHUNK_TOKENS):
+    """返回文件的切块 [(start, end, tokens), ...]；同一文件哈希 + 预算只切一次（内存 + 磁盘缓存）。"""
+    cache_path = os.path.join(os.path.dirname(path), f"{file_hash}.chunks-v{CHUNKS_VERSION}-{max_tokens}.json")
+    if os.path.exists(cache_path):
+        with open(cache_path, encoding="utf-8") as f:
+            return tuple(tuple(c) for c in json.load(f))
+    if os.path.getsize(path) == 0:
+        return ()
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        chunks = _chunk_mmap(mm, max_tokens)
+    # 先写临时文件再替换：中途崩溃或两个会话同时切同一文件，都不会留下半个缓存文件
+    tmp_path = f"{cache_path}.{os.getpid()}-{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(chunks, f)
+    os.replace(tmp_path, cache_path)
+    return tuple(chunks)
+
+def read_chunks(path, chunks):
+    """只从 mmap 里读出需要的几块文本。"""
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return [mm[start:end].decode("utf-8", errors="replace") for start, end, _ in chunks]
+
+########################################
+# 3) 选出与问题相关的块
+########################################
+_WORDS = re.compile(r"[A-Za-z0-9_]{2,}|[一-鿿]+")
+
+def _terms(text):
+    terms = set()
+    for word in _WORDS.findall(text.lower()):
+        if word.isascii():
+            terms.add(word)
+        else:
+            # 中文没有空格，按相邻两个字切成词
+            terms.update(word[i:i + 2] for i in range(max(len(word) - 1, 1)))
+    return terms
+
+def select_chunks(path, chunks, question, top_k=TOP_K_CHUNKS):
+    """返回 [(块序号, 文本), ...]，按在文件中的顺序排列。"""
+    q_terms = _terms(question)
+    scored = []
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for i, (start, end, _) in enumerate(chunks):
+            text = mm[start:end].decode("utf-8", errors="replace").lower()
+            scored.append((sum(1 for t in q_terms if t in text), i))
+    scored.sort(key=lambda x: (-x[0], x[1]))
+    picked = sorted(i for score, i in scored[:top_k] if score > 0) or list(range(min(top_k, len(chunks))))
+    texts = read_chunks(path, [chunks[i] for i in picked])
+    return list(zip(picked, texts))
+
+########################################
+# 4) map：对各块并发提问
+########################################
+def map_messages(chunk_text, question):
+    return [
+        SystemMessage(content=SYSTEM_PROMPT),
+        HumanMessage(content=(
+            "下面是一份文档中的一个片段。请只根据这个片段，简要列出与问题有关的要点；"
+            f"如果片段与问题无关，只回答“{NO_ANSWER}”。\n\n"
+            f"【片段】\n{chunk_text}\n\n【问题】\n{question}"
+        )),
+    ]
+
+async def _map_all(selected, question, pool, max_parallel, stop_event, on_progress):
+    semaphore = asyncio.Semaphore(max_parallel)
+    http_clients = make_http_clients(pool)
+    done = 0
+
+    def stopped():
+        return stop_event is not None and stop_event.is_set()
+
+    async def one(chunk_text):
+        nonlocal done
+        async with semaphore:
+            if stopped():
+                return None
+            parts = []
+            stream = astream_chat(
+                map_messages(chunk_text, question), pool=pool,
+                http_clients=http_clients, temperature=0.0, max_tokens=512,
+            )
+            try:
+                async for text in stream:
+                    if stopped():
+                        return None
+                    parts.append(text)
+            finally:
+                await stream.aclose()  # 中途停止时关闭上游连接
+        done += 1
+        if on_progress is not None:
+            on_progress(done, len(selected))
+        return "".join(parts).strip()
+
+    try:
+        # 某一块重试后仍然失败，不影响其他块的结果
+        return await asyncio.gather(*[one(text) for _, text in selected], return_exceptions=True)
+    finally:
+        await close_http_clients(http_clients)
+
+def map_chunks(selected, question, pool=None, max_parallel=MAX_PARALLEL,
+               stop_event=None, on_progress=None):
+    """对选中的块并发提问，返回 (notes, failed)：notes 为 [(块序号, 要点), ...]（去掉回答“无关”的块），
+    failed 为请求失败的块序号。只有所有块都失败时才抛出异常。
+    在普通线程里调用（内部自己跑事件循环）；stop_event 置位后不再发起新的请求，进行中的也会中止。"""
+    answers = asyncio.run(_map_all(selected, question, pool, max_parallel, stop_event, on_progress))
+    errors = [answer for answer in answers if isinstance(answer, Exception)]
+    if errors and len(errors) == len(answers):
+        raise errors[0]
+    notes = [
+        (i, answer) for (i, _), answer in zip(selected, answers)
+        if isinstance(answer, str) and answer and answer.strip("。. ") != NO_ANSWER
+    ]
+    failed = [i for (i, _), answer in zip(selected, answers) if isinstance(answer, Exception)]
+    return notes, failed
+
+########################################
+# 5) reduce：汇总成最终回答的上下文
+########################################
+def reduce_messages(notes, question, file_name, failed=()):
+    if notes:
+        joined = "\n\n".join(f"【片段 {i + 1}】\n{note}" for i, note in notes)
+    else:
+        joined = "（没有找到与问题相关的内容）"
+    if failed:
+        joined += "\n\n（片段 " + "、".join(str(i + 1) for i in failed) + " 读取失败，未包含在以上要点中）"
+    return [
+        SystemMessage(content=SYSTEM_PROMPT),
+        HumanMessage(content=(
+            f"以下是从文档《{file_name}》各部分提取的与问题相关的要点。"
+            "请综合这些要点回答问题，并注明依据来自哪些片段；要点不足以回答时请直接说明。\n\n"
+            f"{joined}\n\n【问题】\n{question}"
+        )),
+    ]
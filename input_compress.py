@@ -0,0 +1,130 @@
+# 文件名：input_compress.py
+#
+# 发送前的输入压缩：只作用于“传给模型的那份上下文副本”，界面上显示的原始消息不变。
+# 用户粘贴的日志 / 代码里常有大量多余空白、重复行、与前文重复的整段内容，
+# 在完整历史模式下这些内容每一轮都会被重新发送。依次执行：
+#   1) 空白规整：去掉行尾空白、合并连续空行；合并行内连续空格是单独的开关，默认关闭
+#      （代码里的字符串、对齐的列都靠这些空格，合并后模型看到的内容就变了）
+#   2) 连续重复行折叠：保留一行，后面注明重复次数
+#   3) 重复段落折叠：与本条或更早消息里出现过的段落完全相同时，替换为一个简短标记
+#   4) 超长段落截断：保留开头和结尾，中间替换为省略标记
+
+import hashlib
+import re
+
+from langchain.schema import HumanMessage
+
+from chat_core import count_tokens, get_encoding
+
+########################################
+# 1) 配置
+########################################
+class CompressConfig:
+    """各个步骤的开关和阈值；把某一步设为 False / None 即可关闭。"""
+    def __init__(self, normalize_whitespace=True, collapse_inner_spaces=False,
+                 collapse_repeated_lines=True, dedupe_blocks=True, min_dup_block_chars=200,
+                 max_block_tokens=2000, head_ratio=0.7, human_only=True):
+        self.normalize_whitespace = normalize_whitespace
+        self.collapse_inner_spaces = collapse_inner_spaces  # 行内（非缩进部分）的连续空格合并为一个
+        self.collapse_repeated_lines = collapse_repeated_lines
+        self.dedupe_blocks = dedupe_blocks
+        self.min_dup_block_chars = min_dup_block_chars  # 短段落重复很正常（比如“好的”），不折叠
+        self.max_block_tokens = max_block_tokens        # None 表示不截断
+        self.head_ratio = head_ratio                    # 截断时开头保留的比例，其余留给结尾
+        self.human_only = human_only                    # 只压缩用户消息，AI 回复原样发送
+
+########################################
+# 2) 各个步骤
+########################################
+_INNER_SPACES = re.compile(r"(?<=\S)[ \t]{2,}")
+_BLANK_LINES = re.compile(r"\n{3,}")
+
+def normalize_whitespace(text, collapse_inner_spaces=False):
+    lines = [line.rstrip() for line in text.split("\n")]
+    if collapse_inner_spaces:
+        lines = [_INNER_SPACES.sub(" ", line) for line in lines]
+    return _BLANK_LINES.sub("\n\n", "\n".join(lines)).strip("\n")
+
+def collapse_repeated_lines(text):
+    out = []
+    prev, repeats = None, 0
+    for line in text.split("\n") + [None]:  # None 作为结尾哨兵
+        if line == prev and line.strip():
+            repeats += 1
+            continue
+        if repeats:
+            marker = f"[上一行重复 {repeats} 次]"
+            # 只有折叠后确实更短时才折叠
+            out.extend([marker] if len(marker) < repeats * len(prev) else [prev] * repeats)
+        if line is not None:
+            out.append(line)
+        prev, repeats = line, 0
+    return "\n".join(out)
+
+def truncate_block(block, max_tokens, head_ratio):
+    # 每个 token 至少对应一个 UTF-8 字节，字节数不超过上限时不必分词
+    # （字符数不行：生僻汉字、emoji 一个字符就可能是好几个 token）
+    if len(block.encode("utf-8")) <= max_tokens:
+        return block
+    encoding = get_encoding()
+    tokens = encoding.encode(block)
+    if len(tokens) <= max_tokens:
+        return block
+    head = int(max_tokens * head_ratio)
+    tail = max_tokens - head
+    omitted = len(tokens) - head - tail
+    return (
+        encoding.decode(tokens[:head])
+        + f"\n[……中间省略 {omitted} tokens……]\n"
+        + encoding.decode(tokens[-tail:])
+    )
+
+def _block_key(block):
+    return hashlib.sha1(block.strip().encode("utf-8")).digest()
+
+def compress_text(text, config, seen_blocks):
+    """按配置压缩一段文本；seen_blocks 记录已经出现过的段落，跨消息共用。"""
+    if config.normalize_whitespace:
+        text = normalize_whitespace(text, config.collapse_inner_spaces)
+    if config.collapse_repeated_lines:
+        text = collapse_repeated_lines(text)
+
+    blocks = []
+    for block in text.split("\n\n"):
+        if config.dedupe_blocks and len(block) >= config.min_dup_block_chars:
+            key = _block_key(block)
+            if key in seen_blocks:
+                preview = block.strip()[:30].replace("\n", " ")
+                blocks.append(f"[与前文重复的内容已省略：{preview}……]")
+                continue
+            seen_blocks.add(key)
+        if config.max_block_tokens:
+            block = truncate_block(block, config.max_block_tokens, config.head_ratio)
+        blocks.append(block)
+    return "\n\n".join(blocks)
+
+########################################
+# 3) 对整份上下文压缩
+########################################
+def compress_context(messages, config=None):
+    """返回 (压缩后的消息副本, 节省的 token 数)；传入的消息本身不会被修改，
+    界面上显示的仍是原始消息。config 为 None 时使用默认配置。"""
+    config = config or CompressConfig()
+    seen_blocks = set()
+    compressed = []
+    saved = 0
+    for msg in messages:
+        if config.human_only and not isinstance(msg, HumanMessage):
+            compressed.append(msg)
+            continue
+        new_text = compress_text(msg.content, config, seen_blocks)
+        if new_text == msg.content:
+            compressed.append(msg)
+            continue
+        saved += count_tokens(msg.content) - count_tokens(new_text)
+        compressed.append(msg.__class__(content=new_text))
+    return compressed, saved
+
+def saved_note(saved):
+    """附在“[用户消耗 N tokens]”后面的压缩说明；没有节省时为空串。"""
+    return f"，本轮发送前压缩节省 {saved} tokens" if saved else ""
@@ -0,0 +1,282 @@
+# 文件名：llm_balancer.py
+#
+# 多 key / 多接口地址的负载均衡，挂在 ChatOpenAI 底层的 httpx 传输层上：
+#   - 每个请求发往“在途请求少、延迟低”的目标：得分 = (在途数 + 1) × EWMA 延迟 / 权重，取最小
+#   - 返回 429 / 5xx 或连接失败的目标会被暂时摘除（这些响应不计入延迟），冷却时间按连续失败次数指数增长；
+#     冷却结束后先放行一个探测请求，成功才重新加入
+#   - 路由决策和每个目标的吞吐都记在 TargetPool 里，可用 snapshot() 查看
+#
+# secrets.toml 示例（不写 targets 时仍使用原来的单个 api_key）：
+#   [openai]
+#   api_key = "sk-..."
+#   [[openai.targets]]
+#   api_key = "sk-aaa"
+#   base_url = "https://api.deepseek.com"
+#   weight = 2
+
+import collections
+import threading
+import time
+
+import httpx
+
+########################################
+# 1) 单个目标（一个 key + 一个接口地址）的实时状态
+########################################
+class Target:
+    def __init__(self, name, api_key, base_url, weight=1.0, initial_latency=1.0):
+        self.name = name
+        self.api_key = api_key
+        self.base_url = httpx.URL(base_url.rstrip("/"))
+        self.weight = max(float(weight), 0.01)
+        self.ewma_latency = initial_latency  # 秒，按“收到响应头”的时间统计
+        self.in_flight = 0
+        self.failures = 0                    # 连续失败次数
+        self.ejected_until = 0.0             # 在这之前不参与路由
+        self.probing = False                 # 冷却结束后正在进行的探测请求
+        # 指标
+        self.routed = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.bytes_received = 0
+        self.completed_at = collections.deque(maxlen=1000)  # 最近完成请求的时间，用于算吞吐
+
+    def score(self):
+        return (self.in_flight + 1) * self.ewma_latency / self.weight
+
+########################################
+# 2) 目标池：选目标 / 记录结果 / 摘除与恢复
+########################################
+class TargetPool:
+    """线程安全；同一进程内所有会话共用一个，延迟和在途数才是真实的整体负载。"""
+    EWMA_ALPHA = 0.3
+    BASE_COOLDOWN = 5.0    # 第一次失败后摘除的秒数
+    MAX_COOLDOWN = 120.0
+    THROUGHPUT_WINDOW = 60.0
+
+    def __init__(self, targets):
+        if not targets:
+            raise ValueError("目标池里至少需要一个目标")
+        self.targets = list(targets)
+        self.decisions = collections.deque(maxlen=50)  # 最近的路由决策
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """选出一个目标并把它的在途数加一。"""
+        now = time.time()
+        with self._lock:
+            candidates = [t for t in self.targets if t.ejected_until <= now and not t.probing]
+            if candidates:
+                target = min(candidates, key=Target.score)
+                # 冷却刚结束（仍有失败记录）的目标，这次请求就是探测请求
+                if target.failures:
+                    target.probing = True
+                reason = "probe" if target.probing else "score"
+            else:
+                # 全部被摘除时不直接失败，选最快恢复的那个
+                target = min(self.targets, key=lambda t: t.ejected_until)
+                reason = "all-ejected"
+            # 记录的是比较时用的得分（在途数加一之前）
+            self.decisions.append((now, target.name, reason, round(target.score(), 3)))
+            target.in_flight += 1
+            target.routed += 1
+            return target
+
+    def on_response(self, target, status_code, latency, retry_after=None):
+        """收到响应头后调用：更新延迟，遇到 429 / 5xx 摘除目标。"""
+        with self._lock:
+            if status_code == 429 or status_code >= 500:
+                # 限流 / 出错的响应往往立刻返回，不计入延迟；否则恢复后会因为“很快”被集中分到请求
+                self._eject(target, retry_after)
+            else:
+                target.ewma_latency += self.EWMA_ALPHA * (latency - target.ewma_latency)
+                target.failures = 0
+                target.probing = False
+
+    def on_error(self, target):
+        """连接失败等传输层异常。"""
+        with self._lock:
+            self._eject(target)
+
+    def release(self, target, bytes_received=0, ok=True):
+        """响应流读完或关闭后调用。"""
+        with self._lock:
+            target.in_flight -= 1
+            target.bytes_received += bytes_received
+            if ok:
+                target.succeeded += 1
+                target.completed_at.append(time.time())
+            else:
+                target.failed += 1
+
+    def _eject(self, target, retry_after=None):
+        target.failures += 1
+        target.probing = False
+        cooldown = min(self.BASE_COOLDOWN * 2 ** (target.failures - 1), self.MAX_COOLDOWN)
+        if retry_after is not None:
+            cooldown = max(cooldown, retry_after)
+        target.ejected_until = time.time() + cooldown
+
+    def snapshot(self):
+        """每个目标的当前状态和吞吐，用于界面 / 日志展示。"""
+        now = time.time()
+        with self._lock:
+            rows = []
+            for t in self.targets:
+                recent = sum(1 for ts in t.completed_at if now - ts <= self.THROUGHPUT_WINDOW)
+                rows.append({
+                    "目标": t.name,
+                    "权重": t.weight,
+                    "在途": t.in_flight,
+                    "EWMA延迟(s)": round(t.ewma_latency, 3),
+                    "已路由": t.routed,
+                    "成功": t.succeeded,
+                    "失败": t.failed,
+                    "吞吐(次/分)": recent * 60.0 / self.THROUGHPUT_WINDOW,
+                    "接收KB": round(t.bytes_received / 1024, 1),
+                    "状态": "摘除" if t.ejected_until > now else ("探测中" if t.probing else "正常"),
+                })
+            return rows
+
+    def recent_decisions(self):
+        """最近的路由决策（从新到旧）；其他线程会同时追加，须在锁内复制。"""
+        with self._lock:
+            return list(reversed(self.decisions))
+
+def pool_from_secrets(openai_secrets, default_base_url):
+    """从 st.secrets["openai"] 构造目标池；没有 targets 时退回单个 api_key。"""
+    configs = openai_secrets.get("targets") or [
+        {"api_key": openai_secrets["api_key"], "base_url": default_base_url}
+    ]
+    targets = []
+    for i, cfg in enumerate(configs):
+        base_url = cfg.get("base_url", default_base_url)
+        targets.append(Target(
+            name=cfg.get("name", f"{httpx.URL(base_url).host}#{i}"),
+            api_key=cfg["api_key"],
+            base_url=base_url,
+            weight=cfg.get("weight", 1.0),
+        ))
+    return TargetPool(targets)
+
+########################################
+# 3) 传输层：改写请求的地址和 API Key，并跟踪在途 / 延迟
+########################################
+def _route_request(request, target):
+    """把请求改写到目标的地址上（保留原请求的路径），并换成目标的 API Key。"""
+    url = target.base_url.copy_with(
+        raw_path=target.base_url.raw_path.rstrip(b"/") + request.url.raw_path
+    )
+    headers = httpx.Headers(request.headers)
+    headers["Authorization"] = f"Bearer {target.api_key}"
+    headers["Host"] = url.netloc.decode("ascii")
+    return httpx.Request(
+        request.method, url, headers=headers, content=request.content,
+        extensions=request.extensions,
+    )
+
+def _retry_after(response):
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+class _TrackedStream(httpx.SyncByteStream, httpx.AsyncByteStream):
+    """转发响应内容；关闭时把目标的在途数减一，并记录接收字节数。"""
+    def __init__(self, stream, pool, target):
+        self._stream = stream
+        self._pool = pool
+        self._target = target
+        self._bytes = 0
+        self._ok = True
+        self._released = False
+
+    def _release(self):
+        if not self._released:
+            self._released = True
+            self._pool.release(self._target, self._bytes, self._ok)
+
+    def __iter__(self):
+        try:
+            for chunk in self._stream:
+                self._bytes += len(chunk)
+                yield chunk
+        except Exception:
+            self._ok = False
+            raise
+
+    async def __aiter__(self):
+        try:
+            async for chunk in self._stream:
+                self._bytes += len(chunk)
+                yield chunk
+        except Exception:
+            self._ok = False
+            raise
+
+    def close(self):
+        try:
+            self._stream.close()
+        finally:
+            self._release()
+
+    async def aclose(self):
+        try:
+            await self._stream.aclose()
+        finally:
+            self._release()
+
+def _wrap_response(pool, target, response, started_at):
+    pool.on_response(target, response.status_code, time.monotonic() - started_at,
+                     _retry_after(response))
+    ok = response.status_code < 400
+    stream = _TrackedStream(response.stream, pool, target)
+    stream._ok = ok
+    return httpx.Response(
+        status_code=response.status_code,
+        headers=response.headers,
+        stream=stream,
+        extensions=response.extensions,
+    )
+
+class BalancingTransport(httpx.BaseTransport):
+    """同步版负载均衡传输层；transport 为实际发请求的下层传输（也可以是录制 / 回放）。"""
+    def __init__(self, pool, transport=None):
+        self.pool = pool
+        self.transport = transport or httpx.HTTPTransport()
+
+    def handle_request(self, request):
+        request.read()
+        target = self.pool.acquire()
+        started_at = time.monotonic()
+        try:
+            response = self.transport.handle_request(_route_request(request, target))
+        except Exception:
+            self.pool.on_error(target)
+            self.pool.release(target, ok=False)
+            raise
+        return _wrap_response(self.pool, target, response, started_at)
+
+    def close(self):
+        self.transport.close()
+
+class AsyncBalancingTransport(httpx.AsyncBaseTransport):
+    """异步版负载均衡传输层。"""
+    def __init__(self, pool, transport=None):
+        self.pool = pool
+        self.transport = transport or httpx.AsyncHTTPTransport()
+
+    async def handle_async_request(self, request):
+        await request.aread()
+        target = self.pool.acquire()
+        started_at = time.monotonic()
+        try:
+            response = await self.transport.handle_async_request(_route_request(request, target))
+        except Exception:
+            self.pool.on_error(target)
+            self.pool.release(target, ok=False)
+            raise
+        return _wrap_response(self.pool, target, response, started_at)
+
+    async def aclose(self):
+        await self.transport.aclose()
@@ -0,0 +1,166 @@
+# 文件名：llm_client.py
+#
+# 统一创建 ChatOpenAI（deepseek-chat 兼容）对象的地方。
+# 通过环境变量可以在客户端底层挂上录制 / 回放传输层（见 llm_transport.py），用于离线测试和基准：
+#   LLM_CASSETTE_MODE = off（默认）| record | replay
+#   LLM_CASSETTE_DIR  = cassette 文件目录，默认 ./cassettes
+#   LLM_REPLAY_SPEED  = recorded（默认，按录制速度）| fast（不等待）
+# 传入目标池（见 llm_balancer.py）时，请求会在多个 key / 接口地址之间负载均衡。
+
+import asyncio
+import json
+import os
+
+import httpx
+from langchain_openai import ChatOpenAI
+
+from llm_balancer import AsyncBalancingTransport, BalancingTransport
+from llm_transport import AsyncRecordingTransport, RecordingTransport, ReplayTransport
+
+DEFAULT_MODEL = "deepseek-chat"
+DEFAULT_API_BASE = "https://api.deepseek.com"
+
+# 使用目标池时 ChatOpenAI 看到的占位地址 / key，真正的地址和 key 由负载均衡传输层改写
+POOL_API_BASE = "http://llm-pool"
+POOL_API_KEY = "pool"
+
+# 自建 httpx 传输层时的连接数上限；无界面服务需要同时维持大量流式连接
+HTTP_LIMITS = httpx.Limits(max_connections=1000, max_keepalive_connections=200)
+
+# 回放时代替 secrets 里的 [openai] 配置：回放不联网，不需要真实的 key，也就不必有 secrets.toml
+REPLAY_SECRETS = {"api_key": "replay"}
+
+########################################
+# 1) 按环境变量构造底层 httpx 客户端
+########################################
+def cassette_mode():
+    mode = os.environ.get("LLM_CASSETTE_MODE", "off").lower()
+    if mode not in ("off", "record", "replay"):
+        raise ValueError(f"未知的 LLM_CASSETTE_MODE：{mode}，可选 off / record / replay")
+    return mode
+
+def make_http_clients(pool=None):
+    """返回 (http_client, http_async_client)；既没有目标池、也未开启录制 / 回放时都为 None，
+    使用 openai 默认客户端。"""
+    mode = cassette_mode()
+    cassette_dir = os.environ.get("LLM_CASSETTE_DIR", "cassettes")
+
+    if mode == "replay":
+        # 回放不联网，也就不需要负载均衡
+        transport = ReplayTransport(cassette_dir, speed=os.environ.get("LLM_REPLAY_SPEED", "recorded"))
+        return (
+            httpx.Client(transport=transport, timeout=None),
+            httpx.AsyncClient(transport=transport, timeout=None),
+        )
+
+    if pool is not None:
+        sync_transport = BalancingTransport(pool, httpx.HTTPTransport(limits=HTTP_LIMITS))
+        async_transport = AsyncBalancingTransport(pool, httpx.AsyncHTTPTransport(limits=HTTP_LIMITS))
+    elif mode == "record":
+        sync_transport = httpx.HTTPTransport(limits=HTTP_LIMITS)
+        async_transport = httpx.AsyncHTTPTransport(limits=HTTP_LIMITS)
+    else:
+        return None, None
+
+    if mode == "record":
+        # 录制放在负载均衡外层：cassette 按占位地址记录，回放时与实际用了哪个目标无关
+        sync_transport = RecordingTransport(cassette_dir, sync_transport)
+        async_transport = AsyncRecordingTransport(cassette_dir, async_transport)
+    return (
+        httpx.Client(transport=sync_transport, timeout=None),
+        httpx.AsyncClient(transport=async_transport, timeout=None),
+    )
+
+async def close_http_clients(http_clients):
+    """关闭 make_http_clients() 返回的一组客户端（为 None 的跳过）。"""
+    http_client, http_async_client = http_clients
+    if http_client is not None:
+        http_client.close()
+    if http_async_client is not None:
+        await http_async_client.aclose()
+
+########################################
+# 2) 创建 ChatOpenAI
+########################################
+def create_chat_llm(api_key=None, api_base=DEFAULT_API_BASE, temperature=0.7, max_tokens=1024,
+                    streaming=True, pool=None, http_clients=None, **kwargs):
+    """创建 ChatOpenAI；传入 pool 时忽略 api_key / api_base，由目标池决定每个请求发往哪里。
+    http_clients 为 make_http_clients() 的返回值，长期运行的服务可以复用同一组连接；
+    其余参数（callback_manager 等）原样传给 ChatOpenAI。"""
+    if pool is not None:
+        api_key, api_base = POOL_API_KEY, POOL_API_BASE
+    if http_clients is None:
+        http_clients = make_http_clients(pool)
+    http_client, http_async_client = http_clients
+    return ChatOpenAI(
+        openai_api_key=api_key,
+        model_name=DEFAULT_MODEL,
+        openai_api_base=api_base,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        streaming=streaming,
+        http_client=http_client,
+        http_async_client=http_async_client,
+        **kwargs
+    )
+
+########################################
+# 3) 轻量异步流式调用（无界面服务用）
+########################################
+# LangChain 消息类型 -> OpenAI 接口的 role
+MESSAGE_ROLES = {"system": "system", "human": "user", "ai": "assistant"}
+
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+async def astream_chat(messages, api_key=None, api_base=DEFAULT_API_BASE, temperature=0.7,
+                       max_tokens=1024, pool=None, http_clients=None, max_retries=2):
+    """不经过 ChatOpenAI、直接按 OpenAI 流式协议逐段产出回答文本。
+
+    走的是同一套 httpx 传输层（负载均衡 / 录制回放），请求体与 ChatOpenAI 发出的一致，
+    cassette 可以互通；省掉了每个分块都要构造 openai / LangChain 对象的开销，
+    适合一个进程里同时维持大量流。提前结束迭代（aclose）会关闭上游连接。
+    """
+    if pool is not None:
+        api_key, api_base = POOL_API_KEY, POOL_API_BASE
+    if http_clients is None:
+        http_clients = make_http_clients(pool)
+    client = http_clients[1]
+    own_client = client is None
+    if own_client:
+        client = httpx.AsyncClient(timeout=None)
+
+    payload = {
+        "messages": [{"content": m.content, "role": MESSAGE_ROLES[m.type]} for m in messages],
+        "model": DEFAULT_MODEL,
+        "max_tokens": max_tokens,
+        "n": 1,
+        "stream": True,
+        "temperature": temperature,
+    }
+    headers = {"Authorization": f"Bearer {api_key}"}
+    url = f"{api_base.rstrip('/')}/chat/completions"
+    try:
+        for attempt in range(max_retries + 1):
+            async with client.stream("POST", url, json=payload, headers=headers) as response:
+                if response.status_code in RETRY_STATUS and attempt < max_retries:
+                    # 负载均衡下，重试会落到另一个目标上
+                    await response.aread()
+                    await asyncio.sleep(0.5 * 2 ** attempt)
+                    continue
+                if response.status_code >= 400:
+                    await response.aread()
+                    response.raise_for_status()
+                async for line in response.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[5:].strip()
+                    if data == "[DONE]":
+                        return
+                    choices = json.loads(data).get("choices") or []
+                    content = choices[0].get("delta", {}).get("content") if choices else None
+                    if content:
+                        yield content
+                return
+    finally:
+        if own_client:
+            await client.aclose()
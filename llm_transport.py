@@ -0,0 +1,194 @@
+# 文件名：llm_transport.py
+#
+# 挂在 ChatOpenAI 底层 httpx 客户端上的“录制 / 回放”传输层。
+#   - 录制：照常请求真实接口，同时把流式响应（含每个分块的到达间隔）存成压缩的 cassette 文件
+#   - 回放：不联网，按请求哈希找到 cassette，按录制时的速度或尽可能快地吐出同样的分块
+# 上层的 ChatOpenAI / 回调 / 界面代码都不需要改动。
+
+import asyncio
+import base64
+import gzip
+import hashlib
+import json
+import os
+import time
+
+import httpx
+
+########################################
+# 1) cassette 文件的读写
+########################################
+class CassetteNotFound(Exception):
+    """回放模式下找不到与请求对应的 cassette 文件。"""
+    pass
+
+def request_key(request):
+    """按“方法 + 路径 + 请求体”计算请求哈希（不含域名和 API Key，换 key/换地址也能回放）。"""
+    body = request.content
+    try:
+        # JSON 请求体按 key 排序后再算哈希，避免字段顺序不同导致对不上
+        body = json.dumps(json.loads(body), sort_keys=True, ensure_ascii=False).encode("utf-8")
+    except ValueError:
+        pass
+    digest = hashlib.sha256()
+    digest.update(request.method.encode("ascii"))
+    digest.update(request.url.raw_path)
+    digest.update(body)
+    return digest.hexdigest()
+
+def cassette_path(cassette_dir, key):
+    return os.path.join(cassette_dir, f"{key[:32]}.json.gz")
+
+def save_cassette(path, request, status_code, headers, chunks):
+    """chunks: [(距上一个分块的秒数, bytes), ...]"""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    data = {
+        "method": request.method,
+        "url": str(request.url.copy_with(query=None)),
+        "status": status_code,
+        "headers": [[k, v] for k, v in headers.items()],
+        "chunks": [
+            [round(delay, 4), base64.b64encode(chunk).decode("ascii")]
+            for delay, chunk in chunks
+        ],
+    }
+    tmp_path = path + ".tmp"
+    with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+        json.dump(data, f, separators=(",", ":"))
+    os.replace(tmp_path, path)  # 先写临时文件再替换，避免中途中断留下半个文件
+
+def load_cassette(path):
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        data = json.load(f)
+    chunks = [(delay, base64.b64decode(chunk)) for delay, chunk in data["chunks"]]
+    return data["status"], data["headers"], chunks
+
+########################################
+# 2) 录制：包一层真实的传输，边转发边记录
+########################################
+class _RecordingStream(httpx.SyncByteStream, httpx.AsyncByteStream):
+    """把上游响应的每个分块原样转发，同时记下分块和到达间隔；读完后写入 cassette。"""
+    def __init__(self, stream, on_finish):
+        self._stream = stream
+        self._on_finish = on_finish
+        self._chunks = []
+        self._last = time.monotonic()
+
+    def _record(self, chunk):
+        now = time.monotonic()
+        self._chunks.append((now - self._last, chunk))
+        self._last = now
+
+    def __iter__(self):
+        for chunk in self._stream:
+            self._record(chunk)
+            yield chunk
+        self._on_finish(self._chunks)
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            self._record(chunk)
+            yield chunk
+        self._on_finish(self._chunks)
+
+    def close(self):
+        self._stream.close()
+
+    async def aclose(self):
+        await self._stream.aclose()
+
+class RecordingTransport(httpx.BaseTransport):
+    """同步版录制传输层。只有完整读完的响应才会被保存（中途停止的不保存）。"""
+    def __init__(self, cassette_dir, transport=None):
+        self.cassette_dir = cassette_dir
+        self.transport = transport or httpx.HTTPTransport()
+
+    def handle_request(self, request):
+        request.read()
+        started_at = time.monotonic()
+        response = self.transport.handle_request(request)
+        return _wrap_recorded(self.cassette_dir, request, response, started_at)
+
+    def close(self):
+        self.transport.close()
+
+class AsyncRecordingTransport(httpx.AsyncBaseTransport):
+    """异步版录制传输层。"""
+    def __init__(self, cassette_dir, transport=None):
+        self.cassette_dir = cassette_dir
+        self.transport = transport or httpx.AsyncHTTPTransport()
+
+    async def handle_async_request(self, request):
+        await request.aread()
+        started_at = time.monotonic()
+        response = await self.transport.handle_async_request(request)
+        return _wrap_recorded(self.cassette_dir, request, response, started_at)
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+def _wrap_recorded(cassette_dir, request, response, started_at):
+    path = cassette_path(cassette_dir, request_key(request))
+
+    def on_finish(chunks):
+        save_cassette(path, request, response.status_code, response.headers, chunks)
+
+    stream = _RecordingStream(response.stream, on_finish)
+    # 第一个分块的间隔从发出请求开始算，回放时也能还原首字延迟
+    stream._last = started_at
+    return httpx.Response(
+        status_code=response.status_code,
+        headers=response.headers,
+        stream=stream,
+        extensions=response.extensions,
+    )
+
+########################################
+# 3) 回放：按请求哈希读取 cassette
+########################################
+REPLAY_SPEEDS = ("recorded", "fast")
+
+class _ReplayStream(httpx.SyncByteStream, httpx.AsyncByteStream):
+    """speed="recorded" 时按录制的间隔逐块输出；"fast" 时不等待。"""
+    def __init__(self, chunks, speed):
+        self._chunks = chunks
+        self._speed = speed
+
+    def __iter__(self):
+        for delay, chunk in self._chunks:
+            if self._speed == "recorded" and delay > 0:
+                time.sleep(delay)
+            yield chunk
+
+    async def __aiter__(self):
+        for delay, chunk in self._chunks:
+            if self._speed == "recorded" and delay > 0:
+                await asyncio.sleep(delay)
+            yield chunk
+
+class ReplayTransport(httpx.BaseTransport, httpx.AsyncBaseTransport):
+    """回放传输层，同步 / 异步客户端都可以使用；完全不访问网络。"""
+    def __init__(self, cassette_dir, speed="recorded"):
+        if speed not in REPLAY_SPEEDS:
+            raise ValueError(f"未知的回放速度：{speed}，可选 {REPLAY_SPEEDS}")
+        self.cassette_dir = cassette_dir
+        self.speed = speed
+
+    def _replay(self, request):
+        path = cassette_path(self.cassette_dir, request_key(request))
+        if not os.path.exists(path):
+            raise CassetteNotFound(f"没有找到请求 {request.method} {request.url} 的录制：{path}")
+        status, headers, chunks = load_cassette(path)
+        return httpx.Response(
+            status_code=status,
+            headers=headers,
+            stream=_ReplayStream(chunks, self.speed),
+        )
+
+    def handle_request(self, request):
+        request.read()
+        return self._replay(request)
+
+    async def handle_async_request(self, request):
+        await request.aread()
+        return self._replay(request)
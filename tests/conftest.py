@@ -0,0 +1,26 @@
+import os
+import sys
+
+import tiktoken
+
+# 应用模块都在仓库根目录，直接 import
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+class ByteEncoding:
+    """离线替身：每个 UTF-8 字节算一个 token。
+    真正的 cl100k_base 首次使用时要联网下载词表，CI 里不一定能访问。"""
+    name = "bytes"
+
+    def encode(self, text, **kwargs):
+        return list(text.encode("utf-8"))
+
+    encode_ordinary = encode
+
+    def encode_ordinary_batch(self, texts, **kwargs):
+        return [self.encode(t) for t in texts]
+
+    def decode(self, tokens, **kwargs):
+        return bytes(tokens).decode("utf-8", errors="replace")
+
+tiktoken.get_encoding = lambda name: ByteEncoding()
+tiktoken.encoding_for_model = lambda model_name: ByteEncoding()
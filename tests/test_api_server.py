@@ -0,0 +1,34 @@
+# 文件名：test_api_server.py
+#
+# 请求体校验：不合法的请求体一律返回 400，而不是 500。
+
+import asyncio
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+from api_server import create_app
+from llm_balancer import pool_from_secrets
+from llm_client import DEFAULT_API_BASE, REPLAY_SECRETS
+
+@pytest.mark.parametrize("body", [
+    "[1, 2]",
+    '"hello"',
+    "null",
+    "not json",
+    '{"messages": []}',
+    '{"messages": [{"role": "tool", "content": "x"}]}',
+    '{"messages": [{"role": "user", "content": "x"}], "context_window": 0}',
+    '{"messages": [{"role": "user", "content": "x"}], "context_window": -2}',
+])
+def test_invalid_body_returns_400(body):
+    async def post():
+        app = create_app(pool_from_secrets(REPLAY_SECRETS, DEFAULT_API_BASE))
+        async with TestClient(TestServer(app)) as client:
+            response = await client.post("/v1/chat/completions", data=body,
+                                         headers={"Content-Type": "application/json"})
+            return response.status, await response.json()
+
+    status, data = asyncio.run(post())
+    assert status == 400
+    assert data["error"]["message"]
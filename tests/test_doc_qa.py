@@ -0,0 +1,69 @@
+# 文件名：test_doc_qa.py
+#
+# 切块：每块的 token 数不超过预算，且各块首尾相接、覆盖整个文件。
+
+import mmap
+import threading
+
+import pytest
+
+import doc_qa
+
+class CharEncoding:
+    """每个字符算一个 token：最“密”的情况，按字节切出来的片段 token 数最多。"""
+    def encode_ordinary(self, text):
+        return list(text)
+
+    def encode_ordinary_batch(self, texts):
+        return [self.encode_ordinary(t) for t in texts]
+
+@pytest.mark.parametrize("content", [
+    "a" * 20000,                                   # 没有换行的超长单字节行
+    "你好世界" * 3000,                              # 超长多字节行
+    ("短行\n" * 500) + "x" * 9000 + "\n" + "尾" * 10,
+], ids=["ascii-line", "utf8-line", "mixed"])
+def test_chunks_stay_within_budget(monkeypatch, tmp_path, content):
+    monkeypatch.setattr(doc_qa, "get_encoding", CharEncoding)
+    path = tmp_path / "doc.txt"
+    path.write_bytes(content.encode("utf-8"))
+    max_tokens = 3000
+
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        chunks = doc_qa._chunk_mmap(mm, max_tokens)
+        texts = [mm[start:end].decode("utf-8") for start, end, _ in chunks]
+
+    assert all(n <= max_tokens for _, _, n in chunks)
+    assert [n for _, _, n in chunks] == [len(t) for t in texts]
+    assert "".join(texts) == content
+
+def test_failed_chunks_are_skipped(monkeypatch):
+    async def fake_stream(messages, **kwargs):
+        if "坏" in messages[1].content:
+            raise RuntimeError("429")
+        yield "要点"
+
+    monkeypatch.setattr(doc_qa, "astream_chat", fake_stream)
+    notes, failed = doc_qa.map_chunks([(0, "好"), (1, "坏"), (2, "好")], "问题")
+    assert notes == [(0, "要点"), (2, "要点")]
+    assert failed == [1]
+    assert "片段 2 读取失败" in doc_qa.reduce_messages(notes, "问题", "doc.txt", failed)[1].content
+
+    with pytest.raises(RuntimeError):
+        doc_qa.map_chunks([(1, "坏")], "问题")
+
+def test_stop_closes_running_streams(monkeypatch):
+    stop_event = threading.Event()
+    closed = []
+
+    async def fake_stream(messages, **kwargs):
+        try:
+            for _ in range(100):
+                stop_event.set()  # 第一段输出之后用户点了停止
+                yield "片段"
+        finally:
+            closed.append(True)
+
+    monkeypatch.setattr(doc_qa, "astream_chat", fake_stream)
+    notes, failed = doc_qa.map_chunks([(0, "a"), (1, "b")], "问题", stop_event=stop_event)
+    assert (notes, failed) == ([], [])
+    assert closed == [True]  # 第二块没有发起请求；第一块的流被关闭
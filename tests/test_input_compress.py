@@ -0,0 +1,22 @@
+# 文件名：test_input_compress.py
+#
+# 发送前压缩：默认配置不改动代码行内的空格；原始消息不被修改。
+
+from langchain.schema import HumanMessage, SystemMessage
+
+from input_compress import CompressConfig, compress_context, compress_text
+
+CODE = "def f():\n    s = 'a    b'\n    x   = 1   # 对齐\n"
+
+def test_inner_spaces_kept_by_default():
+    assert compress_text(CODE, CompressConfig(), set()) == CODE.rstrip("\n")
+
+def test_inner_spaces_collapsed_when_enabled():
+    config = CompressConfig(collapse_inner_spaces=True)
+    assert compress_text(CODE, config, set()) == "def f():\n    s = 'a b'\n    x = 1 # 对齐"
+
+def test_compress_context_leaves_messages_untouched():
+    messages = [SystemMessage(content="sys"), HumanMessage(content="a  \n\n\n\nb")]
+    compressed, _ = compress_context(messages)
+    assert compressed[1].content == "a\n\nb"
+    assert messages[1].content == "a  \n\n\n\nb"
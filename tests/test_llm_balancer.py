@@ -0,0 +1,32 @@
+# 文件名：test_llm_balancer.py
+#
+# 目标池：出错的响应不计入延迟；路由决策记录的是比较时的得分。
+
+from llm_balancer import Target, TargetPool
+
+def make_pool():
+    return TargetPool([
+        Target("a", "k", "http://a.example"),
+        Target("b", "k", "http://b.example"),
+    ])
+
+def test_error_responses_do_not_update_latency():
+    pool = make_pool()
+    target = pool.acquire()
+    pool.on_response(target, 429, latency=0.01)
+    pool.release(target, ok=False)
+    assert target.ewma_latency == 1.0
+    assert target.ejected_until > 0
+
+    other = pool.acquire()
+    assert other is not target
+    pool.on_response(other, 200, latency=0.1)
+    assert other.ewma_latency < 1.0
+
+def test_decision_records_compared_score():
+    pool = make_pool()
+    target = pool.acquire()
+    _, name, reason, score = pool.recent_decisions()[0]
+    assert (name, reason) == (target.name, "score")
+    assert score == 1.0  # (0 在途 + 1) × 1.0 / 1.0
+    assert target.in_flight == 1
@@ -0,0 +1,56 @@
+# 文件名：test_replay.py
+#
+# 用录制好的 cassette（tests/cassettes）回放整个对话流程，不联网、不需要 secrets.toml。
+# cassette 是对着本地模拟接口录制的：LLM_CASSETTE_MODE=record 下在 app_v8 里问一句“你好”。
+# 请求体（系统提示词、上下文、温度等）一变，哈希就对不上，需要重新录制。
+
+import asyncio
+import os
+import time
+
+import pytest
+from langchain.schema import HumanMessage, SystemMessage
+from streamlit.testing.v1 import AppTest
+
+from chat_core import SYSTEM_PROMPT, count_tokens
+from llm_client import astream_chat
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CASSETTE_DIR = os.path.join(ROOT, "tests", "cassettes")
+
+PROMPT = "你好"
+ANSWER = "你好！我是一个AI助手，可以帮你解答问题、整理资料或者写代码。有什么需要帮忙的吗？"
+
+@pytest.fixture
+def replay_env(monkeypatch, tmp_path):
+    monkeypatch.setenv("LLM_CASSETTE_MODE", "replay")
+    monkeypatch.setenv("LLM_CASSETTE_DIR", CASSETTE_DIR)
+    monkeypatch.setenv("LLM_REPLAY_SPEED", "fast")
+    monkeypatch.setenv("LLM_METRICS_DIR", str(tmp_path / "turn_metrics"))
+
+def test_astream_chat_replay(replay_env):
+    async def collect():
+        messages = [SystemMessage(content=SYSTEM_PROMPT), HumanMessage(content=PROMPT)]
+        return "".join([piece async for piece in astream_chat(messages, api_key="unused")])
+
+    assert asyncio.run(collect()) == ANSWER
+
+def test_app_v8_replay_without_secrets(replay_env):
+    at = AppTest.from_file(os.path.join(ROOT, "app_v8.py"), default_timeout=30)
+    at.run()
+    assert not at.exception
+
+    at.chat_input[0].set_value(PROMPT).run()
+    # 回答在后台线程里生成；像浏览器的定时刷新一样重跑，直到这一轮结束
+    deadline = time.monotonic() + 10
+    while at.session_state["stream_jobs"] and time.monotonic() < deadline:
+        time.sleep(0.05)
+        at.run()
+
+    assert not at.exception
+    assert not at.session_state["stream_jobs"]
+    messages = at.session_state["messages"]
+    assert [m.content for m in messages[1:]] == [PROMPT, ANSWER]
+    assert at.chat_message[-1].markdown[0].value == ANSWER
+    # 上下文 token 数包含系统提示词，与 api_server 的统计口径一致
+    assert at.session_state["context_tokens"] == count_tokens(SYSTEM_PROMPT) + count_tokens(PROMPT)
@@ -0,0 +1,133 @@
+# 文件名：turn_metrics.py
+#
+# 每轮对话的指标（上下文大小、token 数、首字延迟、用时、是否中止……）：
+#   1) 记录：先攒在内存里，攒够一批或隔一段时间再写成一个 Parquet 文件，
+#      按日期分区（<目录>/date=YYYY-MM-DD/part-xxx.parquet），界面线程里基本没有额外开销
+#   2) 报表：读回整个目录，用 pandas 向量化计算按天、按配置分组的分位数
+#
+# 用法：python turn_metrics.py --dir turn_metrics
+
+import argparse
+import atexit
+import datetime
+import os
+import threading
+import time
+import uuid
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+METRICS_DIR = os.environ.get("LLM_METRICS_DIR", "turn_metrics")
+
+SCHEMA = pa.schema([
+    ("session_id", pa.string()),
+    ("turn_index", pa.int32()),           # 本轮用户消息在 messages 里的下标
+    ("started_at", pa.timestamp("ms")),
+    ("mode", pa.string()),                # chat / compare / doc_qa / batch
+    ("context_window", pa.int16()),       # get_model_context 的 n
+    ("context_messages", pa.int16()),     # 实际传给模型的消息条数（含系统消息）
+    ("prompt_tokens", pa.int32()),        # 压缩后的上下文 token 数
+    ("prompt_tokens_saved", pa.int32()),  # 发送前压缩节省的 token 数
+    ("completion_tokens", pa.int32()),
+    ("ttft_s", pa.float32()),             # 首字延迟；没有输出时为空
+    ("duration_s", pa.float32()),
+    ("temperature", pa.float32()),
+    ("candidates", pa.int8()),            # 对比模式下同时生成的候选数
+    ("compressed", pa.bool_()),
+    ("cancelled", pa.bool_()),            # 用户中止
+    ("truncated", pa.bool_()),            # 因退化输出提前截断（见 degenerate.py）
+    ("error", pa.bool_()),
+    ("date", pa.string()),                # 分区列
+])
+
+# 报表里默认的“配置”分组列
+CONFIG_COLUMNS = ["mode", "context_window", "temperature", "compressed"]
+PERCENTILES = [0.5, 0.9, 0.99]
+
+########################################
+# 1) 记录 & 批量写入
+########################################
+class TurnMetricsRecorder:
+    """线程安全的内存缓冲；满 batch_size 条或距上次写入超过 flush_interval 秒时写一个 Parquet 文件。"""
+    def __init__(self, root_dir=METRICS_DIR, batch_size=200, flush_interval=60.0):
+        self.root_dir = root_dir
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._rows = []
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        atexit.register(self.flush)  # 进程退出前把剩下的也写掉
+
+    def record(self, started_at, **fields):
+        """记一轮；started_at 为 time.time() 时间戳，其余字段见 SCHEMA。"""
+        started = datetime.datetime.fromtimestamp(started_at)
+        row = dict(fields, started_at=started, date=started.strftime("%Y-%m-%d"))
+        with self._lock:
+            self._rows.append(row)
+            due = (len(self._rows) >= self.batch_size
+                   or time.monotonic() - self._last_flush >= self.flush_interval)
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            rows, self._rows = self._rows, []
+            self._last_flush = time.monotonic()
+        if not rows:
+            return
+        table = pa.Table.from_pylist(rows, schema=SCHEMA)
+        pq.write_to_dataset(
+            table, self.root_dir, partition_cols=["date"],
+            basename_template=f"part-{int(time.time())}-{uuid.uuid4().hex[:8]}-{{i}}.parquet",
+        )
+
+########################################
+# 2) 报表（向量化分位数）
+########################################
+def load_metrics(root_dir=METRICS_DIR):
+    df = pd.read_parquet(root_dir)
+    df["date"] = df["date"].astype(str)
+    return df
+
+def percentile_report(df, by):
+    """按 by 分组，给出轮数、中止 / 截断比例，以及首字延迟、用时、token 数的分位数。"""
+    grouped = df.groupby(by, observed=True, dropna=False)
+    quantiles = grouped[["ttft_s", "duration_s", "prompt_tokens", "completion_tokens"]] \
+        .quantile(PERCENTILES).unstack()
+    quantiles.columns = [f"{col}_p{int(q * 100)}" for col, q in quantiles.columns]
+    summary = grouped.agg(
+        turns=("turn_index", "size"),
+        cancelled_rate=("cancelled", "mean"),
+        truncated_rate=("truncated", "mean"),
+        error_rate=("error", "mean"),
+    )
+    return summary.join(quantiles)
+
+def daily_report(df):
+    return percentile_report(df, ["date"])
+
+def config_report(df, columns=CONFIG_COLUMNS):
+    return percentile_report(df, columns)
+
+########################################
+# 3) 命令行入口
+########################################
+def main():
+    parser = argparse.ArgumentParser(description="每轮对话指标的分位数报表")
+    parser.add_argument("--dir", default=METRICS_DIR, help="Parquet 指标目录")
+    parser.add_argument("--by", nargs="+", default=CONFIG_COLUMNS, help="“按配置”报表的分组列")
+    args = parser.parse_args()
+
+    df = load_metrics(args.dir)
+    with pd.option_context("display.max_columns", None, "display.width", 200,
+                           "display.float_format", "{:.3f}".format):
+        print(f"共 {len(df)} 轮，{df['session_id'].nunique()} 个会话\n")
+        print("按天：")
+        print(daily_report(df))
+        print("\n按配置：")
+        print(config_report(df, args.by))
+
+if __name__ == "__main__":
+    main()